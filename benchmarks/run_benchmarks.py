@@ -0,0 +1,512 @@
+"""
+Times the public entry points of data_loader, preprocessor, data_utils, metrics and convert on synthetic data.
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --output baseline.json
+    python -m benchmarks.run_benchmarks --baseline baseline.json
+
+Every case runs in its own process so that its peak RSS is its own. Results are written as JSON. With `--baseline`, the
+fastest repeat of every case is compared against the same case of an earlier run and the run fails if any case is
+slower by more than `--tolerance` or fails where it used to pass. Timings are only comparable on the same machine, so
+record the baseline with `--output` on the machine that compares against it.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from benchmarks import synthetic
+
+SIZES = {
+    "small": (64, 64, 16),
+    "medium": (256, 256, 64),
+    "large": (512, 512, 128),
+}
+
+# Case name -> setup(ctx) returning the zero-argument callable that is timed
+CASES: Dict[str, Callable[[dict], Callable]] = {}
+
+
+def case(name: str):
+    def _register(setup):
+        CASES[name] = setup
+        return setup
+    return _register
+
+
+def _vol(ctx: dict) -> np.ndarray:
+    from common_utils import preprocessor
+    return preprocessor.normalize_volume(np.load(str(ctx["npy"])))
+
+
+def _out_dir(ctx: dict, name: str) -> Path:
+    path = ctx["root"] / "out" / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+# data_loader
+@case("data_loader.glob_dicom")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.glob_dicom(ctx["dicom"])
+
+
+@case("data_loader.glob_nifti")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.glob_nifti(ctx["nifti"].parent)
+
+
+@case("data_loader.load_dicom_folder")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_dicom_folder(ctx["dicom"])
+
+
+@case("data_loader.load_dicom_folder[4 threads]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_dicom_folder(ctx["dicom"], num_workers=4)
+
+
+@case("data_loader.load_dicom_folder[keep_integer]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_dicom_folder(ctx["dicom"], keep_integer=True)
+
+
+@case("data_loader.load_nifti")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_nifti(ctx["nifti"], "")
+
+
+@case("data_loader.load_nifti[HCP-T1-FLIRT]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_nifti(ctx["nifti"], "HCP-T1-FLIRT")
+
+
+@case("data_loader.load_nifti_lazy[1 slice]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_nifti_lazy(ctx["nifti"], "IXI-T1")[..., 0]
+
+
+@case("data_loader.load_numpy[slices]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_numpy(ctx["npy_slices"])
+
+
+@case("data_loader.load_numpy[stacked]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_numpy(ctx["npy"])
+
+
+@case("data_loader.load_numpy_from_list")
+def _(ctx):
+    from common_utils import data_loader
+    from common_utils.sort_DCM import natural_sort
+    files = natural_sort(list(ctx["npy_slices"].glob("*.npy")))
+    return lambda: data_loader.load_numpy_from_list(files)
+
+
+@case("data_loader.load_data[dicom]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: data_loader.load_data(ctx["dicom"], "dicom", normalize=True)
+
+
+def _store(ctx: dict) -> Path:
+    from common_utils import volume_store
+    path_store = ctx["root"] / "out" / "store"
+    if not volume_store.is_store(path_store):
+        volume_store.save_store(np.load(str(ctx["npy"])), path_store)
+    return path_store
+
+
+@case("data_loader.load_data[store]")
+def _(ctx):
+    from common_utils import data_loader
+    path_store = _store(ctx)
+    return lambda: data_loader.load_data(path_store, "store", normalize=True)
+
+
+@case("data_loader.load_data[store, 1 slice]")
+def _(ctx):
+    from common_utils import data_loader
+    path_store = _store(ctx)
+    return lambda: data_loader.load_data(path_store, "store", normalize=False, slice_range=(0, 1))
+
+
+@case("data_loader.load_data[nifti, resize]")
+def _(ctx):
+    from common_utils import data_loader
+    size = ctx["shape"][0] // 2
+    return lambda: data_loader.load_data(ctx["nifti"], "nifti", normalize=True, target_size=size)
+
+
+@case("data_loader.iter_volumes[4 volumes]")
+def _(ctx):
+    from common_utils import data_loader
+    return lambda: list(data_loader.iter_volumes([ctx["nifti"]] * 4, "nifti", normalize=True))
+
+
+# preprocessor
+@case("preprocessor.crop_fov")
+def _(ctx):
+    from common_utils import preprocessor
+    vol = _vol(ctx)
+    return lambda: preprocessor.crop_fov(vol, vol.shape[0] // 2).copy()
+
+
+@case("preprocessor.mask_subject")
+def _(ctx):
+    from common_utils import preprocessor
+    vol = _vol(ctx)
+    return lambda: preprocessor.mask_subject(vol)
+
+
+@case("preprocessor.normalize_volume")
+def _(ctx):
+    from common_utils import preprocessor
+    vol = np.load(str(ctx["npy"]))
+    return lambda: preprocessor.normalize_volume(vol)
+
+
+@case("preprocessor.normalize_per_slice")
+def _(ctx):
+    from common_utils import preprocessor
+    vol = np.load(str(ctx["npy"]))
+    return lambda: preprocessor.normalize_per_slice(vol)
+
+
+@case("preprocessor.standardize_volume")
+def _(ctx):
+    from common_utils import preprocessor
+    vol = np.load(str(ctx["npy"]))
+    return lambda: preprocessor.standardize_volume(vol)
+
+
+for _backend in ("matmul", "zoom", "skimage"):
+    @case(f"preprocessor.resize_vol[{_backend}]")
+    def _(ctx, backend=_backend):
+        from common_utils import preprocessor
+        vol = _vol(ctx)
+        return lambda: preprocessor.resize_vol(vol, ctx["shape"][0] // 2, backend=backend)
+
+
+# data_utils
+@case("data_utils.crop_central_50pc")
+def _(ctx):
+    from common_utils import data_utils
+    vol = _vol(ctx)
+    return lambda: data_utils.crop_central_50pc(vol).copy()
+
+
+@case("data_utils.fill_subject")
+def _(ctx):
+    from common_utils import data_utils
+    vol = _vol(ctx)
+    return lambda: data_utils.fill_subject(vol)
+
+
+@case("data_utils.mask_subject")
+def _(ctx):
+    from common_utils import data_utils
+    vol = _vol(ctx)
+    return lambda: data_utils.mask_subject(vol)
+
+
+@case("data_utils.mask_subject[uint16]")
+def _(ctx):
+    from common_utils import data_utils
+    vol = np.load(str(ctx["npy"]))  # Stored uint16 values
+    return lambda: data_utils.mask_subject(vol)
+
+
+@case("data_utils.extract_noise_for_AMRI_IP")
+def _(ctx):
+    from common_utils import data_utils
+    vol = _vol(ctx)
+    return lambda: data_utils.extract_noise_for_AMRI_IP(vol)
+
+
+@case("data_utils.extract_noise_var_for_AMRI_IP")
+def _(ctx):
+    from common_utils import data_utils
+    vol = _vol(ctx)
+    return lambda: data_utils.extract_noise_var_for_AMRI_IP(vol)
+
+
+# metrics
+@case("metrics.get_laplacian_var")
+def _(ctx):
+    from common_utils import metrics
+    vol = _vol(ctx)
+    return lambda: metrics.get_laplacian_var(vol)
+
+
+@case("metrics.get_laplacian_var_batch[4 volumes]")
+def _(ctx):
+    from common_utils import metrics
+    vols = [_vol(ctx)] * 4
+    return lambda: metrics.get_laplacian_var_batch(vols)
+
+
+@case("metrics.get_local_SNR_map")
+def _(ctx):
+    from common_utils import metrics
+    vol = _vol(ctx)
+    return lambda: metrics.get_local_SNR_map(vol, noise_var=1e-4)
+
+
+@case("metrics.get_local_SNR_map_for_AMRI_IP")
+def _(ctx):
+    from common_utils import metrics
+    vol = _vol(ctx)
+    return lambda: metrics.get_local_SNR_map_for_AMRI_IP(vol)
+
+
+@case("metrics.get_local_SNR_map_lowfield_phantom")
+def _(ctx):
+    from common_utils import metrics
+    vol = _vol(ctx)
+    return lambda: metrics.get_local_SNR_map_lowfield_phantom(vol, mask_radius=ctx["shape"][0] // 4)
+
+
+# convert
+@case("convert.dcm2npy")
+def _(ctx):
+    from common_utils.convert import dcm2npy
+    return lambda: dcm2npy.dcm2npy(ctx["dicom"], _out_dir(ctx, "dcm2npy"))
+
+
+@case("convert.dcm2npy_dataset[volume]")
+def _(ctx):
+    from common_utils.convert import dcm2npy
+    return lambda: dcm2npy.dcm2npy_dataset(ctx["dicom"].parent, _out_dir(ctx, "dcm2npy_dataset"))
+
+
+@case("convert.dcm2nii")
+def _(ctx):
+    from common_utils.convert import dcm2nii
+    path_save = _out_dir(ctx, "dcm2nii")
+
+    def _run():
+        for f in path_save.glob("*.jsonl"):  # Do not resume from the previous repeat
+            f.unlink()
+        dcm2nii.dcm2nii(ctx["dicom"], path_save)
+    return _run
+
+
+@case("convert.vol2store")
+def _(ctx):
+    from common_utils.convert import vol2store
+    return lambda: vol2store.vol2store(ctx["dicom"], _out_dir(ctx, "vol2store"), "dicom")
+
+
+@case("convert.save_nii")
+def _(ctx):
+    from common_utils.convert import save_nii
+    vol = np.load(str(ctx["npy"]))
+    return lambda: save_nii.save_nii(vol, _out_dir(ctx, "save_nii") / "vol.nii")
+
+
+@case("convert.npy2nii")
+def _(ctx):
+    from common_utils.convert import npy2nii
+    return lambda: npy2nii.main(_out_dir(ctx, "npy2nii") / "vol.nii", path_read_npy=ctx["npy"])
+
+
+@case("convert.npy2mat")
+def _(ctx):
+    from common_utils.convert import npy2mat
+    return lambda: npy2mat.main(ctx["npy"], _out_dir(ctx, "npy2mat") / "vol.mat")
+
+
+@case("convert.save_vol_as_DICOMs")
+def _(ctx):
+    from common_utils import data_loader
+    from common_utils.convert import save_dicom
+    vol, dicoms = data_loader.load_dicom_folder(ctx["dicom"], return_dicoms=True)
+    vol = vol / vol.max()
+    return lambda: save_dicom.save_vol_as_DICOMs(dicoms, vol, _out_dir(ctx, "save_vol_as_DICOMs"))
+
+
+def _rss_mb() -> float:
+    # Current resident set size
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on macOS, KiB on Linux
+
+
+def _reset_peak_rss() -> bool:
+    # Resets the peak RSS of this process so that it only covers what follows, Linux only
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        with open("/proc/self/status") as f:
+            return any(line.startswith("VmHWM:") for line in f)
+    except OSError:
+        return False
+
+
+def _peak_rss_since_reset_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 2 ** 10  # KiB
+
+
+def _run_case(name: str, ctx: dict, repeats: int) -> dict:
+    # Runs in a fresh process per case
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):  # Silence the progress messages of the converters
+            func = CASES[name](ctx)
+            func()  # Warm up imports, caches and the page cache
+            rss_before = _rss_mb()
+            peak_warm_up = _peak_rss_mb()
+            peak_reset = _reset_peak_rss()  # So that the peak of the warm-up call is not counted
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+            peak_timed = _peak_rss_since_reset_mb() if peak_reset else None
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+    median = float(np.median(times))
+    return {
+        "median_s": median,
+        "min_s": float(np.min(times)),
+        "repeats": repeats,
+        "slices_per_s": ctx["shape"][-1] / median if median > 0 else None,
+        "peak_rss_mb": max(peak_warm_up, _peak_rss_mb()),  # Of the whole process, setup and warm-up included
+        # Peak above the RSS before the timed runs, over the timed runs only. None where the peak cannot be reset
+        "peak_rss_increase_mb": max(0.0, peak_timed - rss_before) if peak_timed is not None else None,
+    }
+
+
+def _format_mb(mb: Optional[float]) -> str:
+    return f"{mb:8.1f}" if mb is not None else f"{'-':>8s}"
+
+
+def run(shape: tuple, repeats: int, select: Optional[str] = None, path_data: Optional[Path] = None) -> dict:
+    names = [n for n in CASES if select is None or select in n]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(path_data) if path_data is not None else Path(tmp)
+        print(f"Generating synthetic data of shape {shape} in {root}...")
+        ctx = dict(synthetic.make_dataset(root, shape), root=root, shape=tuple(shape))
+
+        methods = multiprocessing.get_all_start_methods()
+        mp_context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        results = {}
+        for name in names:
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as pool:
+                result = pool.submit(_run_case, name, ctx, repeats).result()
+            results[name] = result
+            if "error" in result:
+                print(f"{name:55s} FAILED: {result['error']}")
+            else:
+                print(f"{name:55s} {result['median_s'] * 1e3:10.2f} ms {result['slices_per_s']:10.1f} slices/s "
+                      f"{_format_mb(result['peak_rss_increase_mb'])} MB")
+
+    return {
+        "meta": {
+            "shape": list(shape),
+            "repeats": repeats,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_s: float = 1e-3) -> list:
+    """
+    Prints the speed-up of every case against `baseline` and returns the cases slower by more than `tolerance` and by
+    more than `min_delta_s` seconds, so that timer noise on sub-millisecond cases is not reported, and the cases that
+    fail but passed in `baseline`. The fastest repeats are compared, as the least affected by other load on the machine.
+    """
+    if results["meta"]["shape"] != baseline["meta"]["shape"]:
+        print(f"Warning: baseline shape {baseline['meta']['shape']} differs from {results['meta']['shape']}")
+
+    regressions = []
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or "error" in base:
+            continue
+        if "error" in result:
+            regressions.append(name)
+            print(f"{name:55s} {base['min_s'] * 1e3:10.2f} ms -> FAILED  REGRESSION")
+            continue
+        ratio = result["min_s"] / base["min_s"]
+        flag = ""
+        if ratio > 1 + tolerance and result["min_s"] - base["min_s"] > min_delta_s:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:55s} {base['min_s'] * 1e3:10.2f} ms -> {result['min_s'] * 1e3:10.2f} ms "
+              f"({1 / ratio:5.2f}x){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--shape", type=int, nargs=3, help="(x, y, slices), overrides --size")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--select", help="Only run cases whose name contains this string")
+    parser.add_argument("--data", type=Path, help="Folder to keep the synthetic data in, temporary by default")
+    parser.add_argument("--output", type=Path, help="JSON file to write results to")
+    parser.add_argument("--baseline", type=Path, help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slow-down before failing, 0.5 = 50%%")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="Slow-downs smaller than this are ignored")
+    args = parser.parse_args()
+
+    shape = tuple(args.shape) if args.shape else SIZES[args.size]
+    results = run(shape, args.repeats, select=args.select, path_data=args.data)
+
+    if args.output is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        print(f"Comparing against {args.baseline}")
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, min_delta_s=args.min_delta_ms / 1e3)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+from pathlib import Path
+from typing import Dict, Tuple
+
+import nibabel as nb
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+
+def make_volume(shape: Tuple[int, int, int], seed: int = 0) -> np.ndarray:
+    """
+    uint16 (x, y, slices) phantom: an elliptical subject with in-plane texture on Rayleigh-like background noise,
+    with empty rows above and below the subject as in AMRI-IP acquisitions.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols, n_slices = shape
+    rows, cols = np.mgrid[:n_rows, :n_cols]
+    vol = np.abs(rng.normal(0, 20, shape))
+    for s in range(n_slices):
+        radius = n_rows * 0.3 + s % 5
+        subject = ((rows - n_rows / 2) / radius) ** 2 + ((cols - n_cols / 2) / (n_cols * 0.35)) ** 2 < 1
+        vol[subject, s] += 1000 + 200 * np.sin(cols[subject] / 5.0)
+    return np.clip(vol, 0, 4095).astype(np.uint16)
+
+
+def _write_dataset(ds: Dataset, path: Path):
+    try:
+        pydicom.dcmwrite(str(path), ds, enforce_file_format=True)  # pydicom >= 3
+    except TypeError:
+        pydicom.dcmwrite(str(path), ds, write_like_original=False)
+
+
+def write_dicom_series(vol: np.ndarray, path_folder: Path, name: str = "IM.MRDC.{}") -> list:
+    """
+    Writes `vol` as a single-frame MR series, one file per slice, with the geometry tags needed for sorting and for
+    dicom2nifti.
+    """
+    path_folder.mkdir(parents=True, exist_ok=True)
+    series_uid, study_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    files = []
+    for i in range(vol.shape[-1]):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.Modality = "MR"
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_uid
+        ds.SeriesNumber = 1
+        ds.AcquisitionNumber = 1
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i)]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [1, 1]
+        ds.SliceThickness = 1
+        ds.Rows, ds.Columns = vol.shape[:2]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = np.ascontiguousarray(vol[..., i]).tobytes()
+
+        path = path_folder / name.format(i + 1)
+        _write_dataset(ds, path)
+        files.append(path)
+    return files
+
+
+def write_nifti(vol: np.ndarray, path_nii: Path) -> Path:
+    path_nii.parent.mkdir(parents=True, exist_ok=True)
+    nb.save(nb.Nifti1Image(vol.astype(np.int16), affine=np.eye(4)), str(path_nii))
+    return path_nii
+
+
+def write_npy_slices(vol: np.ndarray, path_folder: Path) -> list:
+    path_folder.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(vol.shape[-1]):
+        path = path_folder / f"slice_{i}.npy"
+        np.save(str(path), vol[..., i])
+        files.append(path)
+    return files
+
+
+def make_dataset(path_root: Path, shape: Tuple[int, int, int], seed: int = 0) -> Dict[str, Path]:
+    """
+    Writes the same phantom as a DICOM series, a NIFTI, a per-slice .npy folder and a stacked .npy under `path_root`.
+    """
+    vol = make_volume(shape, seed=seed)
+    paths = {
+        "dicom": path_root / "dicom" / "series_0",
+        "nifti": path_root / "nifti" / "vol_0.nii",
+        "npy_slices": path_root / "npy_slices" / "vol_0",
+        "npy": path_root / "npy" / "vol_0.npy",
+    }
+    write_dicom_series(vol, paths["dicom"])
+    write_nifti(vol, paths["nifti"])
+    write_npy_slices(vol, paths["npy_slices"])
+    paths["npy"].parent.mkdir(parents=True, exist_ok=True)
+    np.save(str(paths["npy"]), vol)
+    return paths
@@ -0,0 +1,100 @@
+import asyncio
+import weakref
+from concurrent.futures import Executor
+from functools import partial
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from common_utils import data_loader
+from common_utils import save_dicom
+from common_utils.convert import npy2mat
+from common_utils.convert import npy2nii
+from common_utils.convert import save_nii as _save_nii
+
+# Maximum number of requests loading or saving at once on each event loop. Requests beyond it wait for a free slot,
+# bounding the number of volumes held in memory
+MAX_CONCURRENT_REQUESTS = 4
+
+_SEMAPHORES = weakref.WeakKeyDictionary()  # Event loop -> asyncio.Semaphore
+
+
+def set_concurrency_limit(limit: int):
+    """
+    Sets the maximum number of concurrent requests on the running event loop.
+    """
+    _SEMAPHORES[asyncio.get_running_loop()] = asyncio.Semaphore(limit)
+
+
+def _semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _SEMAPHORES:
+        _SEMAPHORES[loop] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _SEMAPHORES[loop]
+
+
+async def _run(func, *args, executor: Optional[Executor] = None, **kwargs):
+    # Runs blocking `func` in `executor` (the loop's default thread pool if None) within the concurrency limit
+    async with _semaphore():
+        return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+async def load_data(
+        path_data: Union[Path, list],
+        data_format: str,
+        normalize: bool,
+        executor: Optional[Executor] = None,
+        **kwargs,
+):
+    """
+    `data_loader.load_data` without blocking the event loop. DICOM slices are decoded concurrently by
+    `num_workers=4` threads unless `num_workers` is given.
+
+    Parameters
+    ----------
+    path_data : Path or list
+        See `data_loader.load_data`.
+    data_format : str
+        See `data_loader.load_data`.
+    normalize : bool
+        See `data_loader.load_data`.
+    executor : Executor, optional
+        Executor running the load. Defaults to the event loop's default thread pool.
+    **kwargs
+        Remaining `data_loader.load_data` arguments.
+    """
+    if data_format == "dicom":
+        kwargs.setdefault("num_workers", 4)
+    return await _run(data_loader.load_data, path_data, data_format, normalize, executor=executor, **kwargs)
+
+
+async def save_vol_as_DICOMs(
+        original_dicoms, vol: np.ndarray, path_save: Path, executor: Optional[Executor] = None, **kwargs
+):
+    """
+    `save_dicom.save_vol_as_DICOMs` without blocking the event loop.
+    """
+    await _run(save_dicom.save_vol_as_DICOMs, original_dicoms, vol, path_save, executor=executor, **kwargs)
+
+
+async def save_nii(npy: np.ndarray, path_save_nii: Path, executor: Optional[Executor] = None):
+    """
+    `convert.save_nii.save_nii` without blocking the event loop.
+    """
+    await _run(_save_nii.save_nii, npy, path_save_nii, executor=executor)
+
+
+async def save_npy_as_nii(path_save_nii: Path, npy: np.ndarray = np.array([]), path_read_npy: Path = Path(),
+                          executor: Optional[Executor] = None):
+    """
+    `convert.npy2nii.main` without blocking the event loop.
+    """
+    await _run(npy2nii.main, path_save_nii, npy=npy, path_read_npy=path_read_npy, executor=executor)
+
+
+async def save_npy_as_mat(path_read_npy: Path, path_save_mat: Path, executor: Optional[Executor] = None):
+    """
+    `convert.npy2mat.main` without blocking the event loop.
+    """
+    await _run(npy2mat.main, path_read_npy, path_save_mat, executor=executor)
@@ -0,0 +1,243 @@
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple, Union
+
+import numpy as np
+from skimage.draw import disk
+
+from common_utils import data_utils
+from common_utils import metrics
+from common_utils import preprocessor
+from common_utils.integer_volume import IntegerVolume
+
+# Out-of-core versions of the preprocessor, data_utils and metrics operations, run over slabs of slices of a
+# (x, y, slices) volume such as `np.load(..., mmap_mode="r")`, see `map_slabs`
+Output = Union[np.ndarray, Path, str, None]
+
+
+def open_output(path_npy: Union[Path, str], shape: tuple, dtype=np.float64) -> np.memmap:
+    """
+    Creates a writeable .npy memmap in Fortran order, so every slab of slices is one contiguous block on disk.
+    """
+    return np.lib.format.open_memmap(str(path_npy), mode="w+", dtype=dtype, shape=tuple(shape), fortran_order=True)
+
+
+def _as_output(out: Output, shape: tuple, dtype: np.dtype) -> np.ndarray:
+    # In-memory array if `out` is None, a new .npy memmap if `out` is a path, else `out` itself
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(out, (Path, str)):
+        return open_output(out, shape, dtype)
+    if out.shape != tuple(shape):
+        raise ValueError(f"out must have shape {tuple(shape)}, got {out.shape}")
+    return out
+
+
+def _flush(out: np.ndarray):
+    if isinstance(out, np.memmap):
+        out.flush()
+
+
+def iter_slabs(n_slices: int, slab_size: int, halo: int = 0) -> Iterator[Tuple[slice, slice, slice]]:
+    """
+    Splits `n_slices` into slabs of `slab_size` slices.
+
+    Yields
+    ======
+    read : slice
+        Slices to read, the slab plus up to `halo` slices on each side.
+    core : slice
+        The slab within the slices read.
+    write : slice
+        The slab within the volume.
+    """
+    for start in range(0, n_slices, slab_size):
+        stop = min(start + slab_size, n_slices)
+        lo, hi = max(0, start - halo), min(n_slices, stop + halo)
+        yield slice(lo, hi), slice(start - lo, stop - lo), slice(start, stop)
+
+
+def map_slabs(
+        func: Callable[[np.ndarray], np.ndarray],
+        vol: np.ndarray,
+        out: Output = None,
+        out_shape: Optional[tuple] = None,
+        dtype: Optional[np.dtype] = None,
+        slab_size: int = 16,
+        halo: int = 0,
+) -> np.ndarray:
+    """
+    Applies `func` to slabs of slices of `vol` and writes the results into `out`. Only one slab (plus halo) is read
+    into memory at a time, so `vol` and `out` can be memmaps larger than memory.
+
+    Parameters
+    ==========
+    func : callable
+        Maps an (x, y, slices) slab to an array with the same number of slices.
+    vol : np.ndarray
+        Input volume of shape (x, y, slices, ...), e.g. a np.memmap.
+    out : np.ndarray or Path, optional
+        Output array, or path of a .npy memmap to create. Defaults to an in-memory array.
+    out_shape : tuple, optional
+        Shape of the output. Defaults to the shape of `vol`.
+    dtype : np.dtype, optional
+        dtype of a created output. Defaults to `preprocessor.float_dtype(vol)`.
+    slab_size : int, default=16
+        Slices per slab.
+    halo : int, default=0
+        Extra slices read on each side of a slab, for operations that look at neighbouring slices. `func` sees them
+        but only the slab's own slices are written.
+    """
+    out_shape = vol.shape if out_shape is None else tuple(out_shape)
+    out = _as_output(out, out_shape, preprocessor.float_dtype(vol, dtype))
+
+    for read, core, write in iter_slabs(vol.shape[2], slab_size, halo):
+        result = func(np.asarray(vol[:, :, read]))
+        out[:, :, write] = result[:, :, core]
+
+    _flush(out)
+    return out
+
+
+def normalize_volume(
+        vol: np.ndarray, out: Output = None, dtype: Optional[np.dtype] = None, slab_size: int = 16
+) -> np.ndarray:
+    """
+    `preprocessor.normalize_volume`, with the min and max gathered over all slabs before any slab is written.
+    """
+    dtype = preprocessor.float_dtype(vol, dtype)
+    _min, _max = None, None
+    for read, _, _ in iter_slabs(vol.shape[2], slab_size):
+        slab_min, slab_max = preprocessor.min_max(np.asarray(vol[:, :, read]))
+        _min = slab_min if _min is None else min(_min, slab_min)
+        _max = slab_max if _max is None else max(_max, slab_max)
+    _min = dtype.type(_min)
+    _range = dtype.type(_max) - _min
+
+    def _normalize(slab):
+        return (preprocessor.as_float(slab, dtype) - _min) / _range
+
+    return map_slabs(_normalize, vol, out=out, dtype=dtype, slab_size=slab_size)
+
+
+def mask_subject(vol: np.ndarray, out: Output = None, slab_size: int = 16) -> np.ndarray:
+    """
+    `data_utils.mask_subject`. The subject threshold is per slice, so every slab is masked independently.
+    """
+    return map_slabs(data_utils.mask_subject, vol, out=out, dtype=vol.dtype, slab_size=slab_size)
+
+
+def extract_noise_var_for_AMRI_IP(
+        vol_noisy: np.ndarray, dtype: Optional[np.dtype] = None, slab_size: int = 16
+) -> float:
+    """
+    `data_utils.extract_noise_var_for_AMRI_IP`, accumulated over slabs.
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    for read, _, _ in iter_slabs(vol_noisy.shape[2], slab_size):
+        slab = preprocessor.as_float(np.asarray(vol_noisy[:, :, read]), dtype)
+        count, mean, m2 = data_utils.accumulate_noise_var_for_AMRI_IP(slab, count, mean, m2)
+
+    if count == 0:
+        return float("nan")
+    return m2 / count
+
+
+def get_local_SNR_map_for_AMRI_IP(
+        vol: np.ndarray,
+        out: Output = None,
+        window: int = 3,
+        mask_brain: bool = True,
+        dtype: Optional[np.dtype] = None,
+        slab_size: int = 16,
+) -> np.ndarray:
+    """
+    `metrics.get_local_SNR_map_for_AMRI_IP`. The noise variance is gathered in a first pass; the SNR map is then
+    computed slab by slab with `window // 2` halo slices, so the 3D box mean matches the whole-volume result.
+    """
+    noise_var = extract_noise_var_for_AMRI_IP(vol, dtype=dtype, slab_size=slab_size)
+
+    def _snr(slab):
+        slab = preprocessor.as_float(slab, dtype)
+        mask = data_utils.subject_mask(slab) if mask_brain else None
+        return metrics.get_local_SNR_map(slab, noise_var, window=window, mask=mask)
+
+    return map_slabs(_snr, vol, out=out, dtype=dtype, slab_size=slab_size, halo=window // 2)
+
+
+def get_local_SNR_map_lowfield_phantom(
+        vol: np.ndarray,
+        out: Output = None,
+        mask_radius: int = 70,
+        window: int = 3,
+        dtype: Optional[np.dtype] = None,
+        slab_size: int = 16,
+) -> np.ndarray:
+    """
+    `metrics.get_local_SNR_map_lowfield_phantom`, with the variance of the background outside the circular mask
+    merged over slabs in a first pass.
+    """
+    center = vol.shape[0] // 2, vol.shape[1] // 2
+    mask = np.zeros(vol.shape[:2], dtype=bool)
+    mask[disk(center=center, radius=mask_radius)] = 1
+
+    count, mean, m2 = 0, 0.0, 0.0
+    for read, _, _ in iter_slabs(vol.shape[2], slab_size):
+        noise = preprocessor.as_float(np.asarray(vol[:, :, read]), dtype)[~mask]
+        if noise.size == 0:
+            continue
+        slab_mean = noise.mean(dtype=np.float64)
+        slab_m2 = np.square(noise - slab_mean).sum(dtype=np.float64)
+        delta = slab_mean - mean
+        total = count + noise.size
+        mean += delta * noise.size / total
+        m2 += slab_m2 + delta ** 2 * count * noise.size / total
+        count = total
+    noise_var = m2 / count if count > 0 else float("nan")
+
+    def _snr(slab):
+        slab = preprocessor.as_float(slab, dtype)
+        return metrics.get_local_SNR_map(slab, noise_var, window=window)
+
+    return map_slabs(_snr, vol, out=out, dtype=dtype, slab_size=slab_size, halo=window // 2)
+
+
+def get_laplacian_var(
+        vol: np.ndarray,
+        mask_brain: bool = True,
+        return_arr: bool = False,
+        dtype: Optional[np.dtype] = None,
+        slab_size: int = 16,
+) -> Union[float, np.ndarray]:
+    """
+    `metrics.get_laplacian_var`. The Laplacian and the brain mask are in-plane, so every slab is independent.
+    """
+    laplace_var_values = np.concatenate([
+        metrics.get_laplacian_var(np.asarray(vol[:, :, read]), mask_brain=mask_brain, return_arr=True, dtype=dtype)
+        for read, _, _ in iter_slabs(vol.shape[2], slab_size)
+    ])
+
+    if return_arr:
+        return laplace_var_values
+    return float(np.median(laplace_var_values))
+
+
+def resize_vol(
+        vol: np.ndarray,
+        size: int,
+        out: Output = None,
+        dtype: Optional[np.dtype] = None,
+        backend: str = "matmul",
+        slab_size: int = 16,
+) -> np.ndarray:
+    """
+    `preprocessor.resize_vol`. Resizing is in-plane, so every slab is independent.
+    """
+    is_integer_volume = isinstance(vol, IntegerVolume)
+
+    def _resize(slab):
+        if is_integer_volume:  # Slabs are read as plain arrays, resize their stored values as they are
+            slab = IntegerVolume(slab)
+        return preprocessor.resize_vol(slab, size, dtype=dtype, backend=backend)
+
+    out_shape = (size, size) + vol.shape[2:]
+    return map_slabs(_resize, vol, out=out, out_shape=out_shape, dtype=dtype, slab_size=slab_size)
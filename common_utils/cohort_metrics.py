@@ -0,0 +1,257 @@
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterable, List, NamedTuple, Sequence
+
+import numpy as np
+
+from common_utils import data_loader
+from common_utils import data_utils
+from common_utils import metrics
+from common_utils import preprocessor
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, only needed for Parquet output
+    pa = None
+    pq = None
+
+
+class Metric(NamedTuple):
+    func: Callable  # func(vol, mask) -> dict of column -> value
+    columns: tuple
+
+
+def _laplacian_var(vol: np.ndarray, mask: np.ndarray) -> dict:
+    return {"laplacian_var": metrics.get_laplacian_var(vol, mask=mask)}
+
+
+def _local_SNR(vol: np.ndarray, mask: np.ndarray) -> dict:
+    # `mask` is memoised for `vol`, so the SNR map reuses it for noise extraction and brain masking
+    snr_map = metrics.get_local_SNR_map_for_AMRI_IP(vol)
+    snr_brain = snr_map[mask]
+    return {"local_SNR_mean": float(snr_brain.mean()), "local_SNR_median": float(np.median(snr_brain))}
+
+
+# Metrics by name, see `register_metric`
+METRICS = {
+    "laplacian_var": Metric(func=_laplacian_var, columns=("laplacian_var",)),
+    "local_SNR": Metric(func=_local_SNR, columns=("local_SNR_mean", "local_SNR_median")),
+}
+
+
+def register_metric(name: str, func: Callable, columns: Sequence[str] = None):
+    """
+    Registers a metric for `run_cohort_metrics`. `func(vol, mask)` receives the loaded volume and its boolean subject
+    mask, computed once per volume, and returns a dict of column -> value. Must be registered at import time of a
+    module the worker processes also import when `num_workers > 0` and processes are spawned rather than forked.
+    """
+    METRICS[name] = Metric(func=func, columns=tuple(columns) if columns is not None else (name,))
+
+
+def _columns(metric_names: Sequence[str]) -> List[str]:
+    columns = ["path", "status", "error", "load_s", "mask_s"]
+    for name in metric_names:
+        columns.append(f"{name}_s")
+        columns.extend(METRICS[name].columns)
+    return columns
+
+
+def _process_subject(path_data: Path, metric_names: Sequence[str], data_format: str, normalize: bool,
+                     load_kwargs: dict) -> dict:
+    # Runs in a worker process, loads one volume and computes every metric on it with a single mask
+    record = {"path": str(path_data), "status": "ok", "error": None}
+    stage = "load"
+    try:
+        start = time.perf_counter()
+        vol = data_loader.load_data(path_data, data_format, normalize, **load_kwargs)
+        vol = preprocessor.as_float(vol, load_kwargs.get("dtype"))  # No copy when already loaded as that dtype
+        record["load_s"] = time.perf_counter() - start
+
+        with data_utils.memoize_masks():
+            stage = "mask"
+            start = time.perf_counter()
+            mask = data_utils.subject_mask(vol)
+            record["mask_s"] = time.perf_counter() - start
+
+            for name in metric_names:
+                stage = name
+                start = time.perf_counter()
+                record.update(METRICS[name].func(vol, mask))
+                record[f"{name}_s"] = time.perf_counter() - start
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{stage}: {type(e).__name__}: {e}"
+
+    return record
+
+
+def _read_completed(path_output: Path) -> set:
+    # Paths already processed successfully by a previous run
+    if not path_output.exists():
+        return set()
+    if path_output.suffix == ".parquet":
+        if pq is None:
+            raise ImportError("pyarrow is required for Parquet output")
+        table = pq.read_table(str(path_output), columns=["path", "status"])
+        return {p for p, s in zip(table.column("path").to_pylist(), table.column("status").to_pylist()) if s == "ok"}
+    with open(path_output, newline="") as f:
+        return {row["path"] for row in csv.DictReader(f) if row.get("status") == "ok"}
+
+
+def _check_columns(path_output: Path, existing: List[str], columns: List[str]):
+    # Rows are appended to the results of a previous run, which must have been computed with the same metrics
+    if list(existing) != list(columns):
+        raise ValueError(f"{path_output} has columns {list(existing)}, expected {columns} for these metrics. "
+                         f"Write to a new path_output or pass the metric_names of the previous run")
+
+
+class _CSVWriter:
+    def __init__(self, path_output: Path, columns: List[str]):
+        new_file = not path_output.exists() or path_output.stat().st_size == 0
+        if not new_file:
+            with open(path_output, newline="") as f:
+                _check_columns(path_output, next(csv.reader(f), []), columns)
+        self._file = open(path_output, "a", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction="ignore")
+        if new_file:
+            self._writer.writeheader()
+
+    def write(self, record: dict):
+        self._writer.writerow(record)
+        self._file.flush()  # Keep the results of a partial run
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    # A folder of part files, readable as one table by `pyarrow.parquet.read_table`. Every part is a complete file,
+    # so an interrupted run keeps every flushed part
+    def __init__(self, path_output: Path, columns: List[str], flush_every: int):
+        if pq is None:
+            raise ImportError("pyarrow is required for Parquet output")
+        path_output.mkdir(parents=True, exist_ok=True)
+        parts = sorted(path_output.glob("part-*.parquet"))
+        if parts:
+            _check_columns(path_output, pq.read_schema(str(parts[0])).names, columns)
+        self._path_output = path_output
+        self._columns = columns
+        self._flush_every = flush_every
+        self._records = []
+        self._part = len(parts)
+
+    def write(self, record: dict):
+        self._records.append(record)
+        if len(self._records) >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._records:
+            return
+        # Explicit schema, so parts whose columns happen to be all None still concatenate
+        schema = pa.schema([(c, pa.string() if c in ("path", "status", "error") else pa.float64())
+                            for c in self._columns])
+        table = pa.Table.from_pydict({c: [r.get(c) for r in self._records] for c in self._columns}, schema=schema)
+        pq.write_table(table, str(self._path_output / f"part-{self._part:05d}.parquet"))
+        self._part += 1
+        self._records = []
+
+    def close(self):
+        self.flush()
+
+
+def run_cohort_metrics(
+        paths: Iterable[Path],
+        path_output: Path,
+        metric_names: Sequence[str] = ("laplacian_var", "local_SNR"),
+        data_format: str = "nifti",
+        normalize: bool = True,
+        num_workers: int = 0,
+        resume: bool = True,
+        flush_every: int = 32,
+        **load_kwargs,
+) -> List[dict]:
+    """
+    Loads every volume and computes `metric_names` on it, sharing one subject mask per volume across all metrics.
+    One row per volume is written as soon as it is done, with per-stage timing (load, mask, each metric) in seconds.
+
+    Parameters
+    ----------
+    paths : iterable
+        Volumes to process, passed to `data_loader.load_data`.
+    path_output : Path
+        Results file. `.parquet` writes a folder of Parquet parts (requires pyarrow), anything else appends to a CSV.
+        An existing file must have the columns of `metric_names`, otherwise a ValueError is raised.
+    metric_names : sequence, default=("laplacian_var", "local_SNR")
+        Names of `METRICS` to compute.
+    data_format : str, default="nifti"
+        See `data_loader.load_data`.
+    normalize : bool, default=True
+        See `data_loader.load_data`.
+    num_workers : int, default=0
+        Number of processes, each loading and computing one volume at a time. 0 processes volumes sequentially in
+        this process.
+    resume : bool, default=True
+        Whether to skip volumes already processed successfully in `path_output`.
+    flush_every : int, default=32
+        Rows per Parquet part.
+    **load_kwargs
+        Remaining `data_loader.load_data` arguments.
+
+    Returns
+    -------
+    records : list
+        One record per volume processed in this run.
+    """
+    unknown = [name for name in metric_names if name not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics {unknown}. Expected some of {list(METRICS)}")
+
+    paths = list(paths)
+    completed = _read_completed(path_output) if resume else set()
+    todo = [p for p in paths if str(p) not in completed]
+    if len(todo) < len(paths):
+        print(f"Skipping {len(paths) - len(todo)} volumes already processed according to {path_output}")
+
+    columns = _columns(metric_names)
+    if path_output.suffix == ".parquet":
+        writer = _ParquetWriter(path_output, columns, flush_every)
+    else:
+        writer = _CSVWriter(path_output, columns)
+
+    records = []
+    try:
+        def _record(i: int, record: dict):
+            writer.write(record)
+            records.append(record)
+            if record["status"] == "ok":
+                timing = ", ".join(f"{c[:-2]} {record[c]:.2f}s" for c in columns if c.endswith("_s"))
+                print(f"{i + 1}/{len(todo)} {record['path']} {timing}")
+            else:
+                print(f"{i + 1}/{len(todo)} {record['path']} FAILED: {record['error']}")
+
+        if num_workers > 0:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                futures = [
+                    pool.submit(_process_subject, p, tuple(metric_names), data_format, normalize, load_kwargs)
+                    for p in todo
+                ]
+                for i, future in enumerate(as_completed(futures)):
+                    _record(i, future.result())
+        else:
+            for i, p in enumerate(todo):
+                _record(i, _process_subject(p, tuple(metric_names), data_format, normalize, load_kwargs))
+    finally:
+        writer.close()
+
+    failed = [r for r in records if r["status"] == "failed"]
+    print(f"Processed {len(records) - len(failed)}/{len(records)} volumes")
+    for stage in [c for c in columns if c.endswith("_s")]:
+        seconds = [r[stage] for r in records if stage in r]
+        if seconds:
+            print(f"{stage[:-2]}: total {sum(seconds):.2f}s, median {np.median(seconds):.2f}s")
+
+    return records
@@ -1,25 +1,30 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Union
+from typing import List, Optional, Tuple
 
 import dicom2nifti as d2n
+from nibabel.openers import Opener
 
+from common_utils import instrumentation
+from common_utils.dicom_index import walk_files
 
-def __get_all_dicom_folders(path_read_dicom: Path) -> Union[Path, List[Path]]:
+
+def __get_all_dicom_folders(path_read_dicom: Path) -> List[Path]:
     print('Gathering all DICOM directories...')
 
-    files = list(path_read_dicom.glob('**/*'))
+    if path_read_dicom.is_file():  # path_read_dicom is a DICOM file itself
+        print('Found 1')
+        return [path_read_dicom.parent]
 
-    if len(files) == 0:  # path_read_dicom is a DICOM file itself
+    # path_read_dicom could be any nested strucutre of DICOM files, gathered in a single os.scandir pass
+    folders = sorted({f.parent for f in walk_files(path_read_dicom)})
+    if len(folders) == 0:
         print('Found 1')
-        return path_read_dicom.parent
-    else:  # path_read_dicom could be any nested strucutre of DICOM files
-        folders = []
-        for f in files:
-            if f.is_file():
-                if f.parent not in folders:
-                    folders.append(f.parent)
-        print(f'Found {len(folders)}')
-        return folders
+        return [path_read_dicom.parent]
+    print(f'Found {len(folders)}')
+    return folders
 
 
 def __prepare_save_dir(path_read_dicom: Path, path_dcm_folder: Path, path_save_nii: Path) -> Path:
@@ -34,20 +39,126 @@ def __prepare_save_dir(path_read_dicom: Path, path_dcm_folder: Path, path_save_n
     return path_save_nii
 
 
-def dcm2nii(path_read_dicom: Path, path_save_nii: Path):
+def __read_manifest(path_manifest: Path) -> set:
+    # Folders whose latest manifest record is a successful conversion
+    completed = set()
+    if not path_manifest.exists():
+        return completed
+
+    with open(path_manifest) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:  # Truncated last line after a crash
+                continue
+            if record['status'] == 'ok':
+                completed.add(record['folder'])
+            else:
+                completed.discard(record['folder'])
+    return completed
+
+
+def __convert_folder(
+        dcm_folder: Path, save_dcm_folder: Path, compression_level: Optional[int]
+) -> Tuple[float, Optional[str]]:
+    # Runs in a worker process, returns (seconds, error)
+    start = time.perf_counter()
+    default_compresslevel = Opener.default_compresslevel
+    try:
+        if compression_level is not None:
+            Opener.default_compresslevel = compression_level  # Used by nibabel when writing .nii.gz
+        d2n.convert_directory(dicom_directory=dcm_folder, output_folder=save_dcm_folder,
+                              compression=compression_level is not None, reorient=True)
+    except Exception as e:
+        return time.perf_counter() - start, f'{type(e).__name__}: {e}'
+    finally:
+        Opener.default_compresslevel = default_compresslevel  # Sequential runs share nibabel with the caller
+    return time.perf_counter() - start, None
+
+
+def dcm2nii(
+        path_read_dicom: Path,
+        path_save_nii: Path,
+        num_workers: int = 0,
+        path_manifest: Optional[Path] = None,
+        compression_level: Optional[int] = None,
+) -> List[dict]:
     """
     Determine if path_read_dicom is:
     1. DICOM directory
     2. Folder of DICOM directories
     3. DICOM file
+
+    Parameters
+    ----------
+    path_read_dicom : Path
+        DICOM file, DICOM directory or any tree of DICOM directories.
+    path_save_nii : Path
+        Output folder. Relative paths are created inside `path_read_dicom`; absolute paths mirror its sub-folders.
+    num_workers : int, default=0
+        Number of processes converting folders in parallel. 0 converts folders sequentially in this process.
+    path_manifest : Path, optional
+        JSON lines file recording every converted folder, its status and timing. Folders already recorded as
+        converted are skipped, so an interrupted run can be resumed. Defaults to `dcm2nii_manifest.jsonl` in the
+        output folder.
+    compression_level : int, optional
+        gzip level (1-9) for writing .nii.gz. None writes uncompressed .nii.
+
+    Returns
+    -------
+    records : list
+        One record per folder processed in this run with its status, seconds and error.
     """
     dicom_folders = __get_all_dicom_folders(path_read_dicom)  # Get all DICOM folders at/inside this path
-    for i, dcm_folder in enumerate(dicom_folders):  # Iterate
-        print(f'{i + 1}/{len(dicom_folders)}')
 
-        save_dcm_folder = __prepare_save_dir(path_read_dicom, dcm_folder, path_save_nii)  # Construct save path
-        d2n.convert_directory(dicom_directory=dcm_folder, output_folder=save_dcm_folder, compression=False,
-                              reorient=True)
+    path_save_root = path_save_nii if path_save_nii.is_absolute() else path_read_dicom / path_save_nii
+    # Outputs of a previous run inside path_read_dicom are not DICOM folders
+    dicom_folders = [f for f in dicom_folders if f != path_save_root and path_save_root not in f.parents]
+
+    if path_manifest is None:
+        path_save_root.mkdir(parents=True, exist_ok=True)
+        path_manifest = path_save_root / 'dcm2nii_manifest.jsonl'
+    completed = __read_manifest(path_manifest)
+    todo = [f for f in dicom_folders if str(f) not in completed]
+    if len(todo) < len(dicom_folders):
+        print(f'Skipping {len(dicom_folders) - len(todo)} folders already converted according to {path_manifest}')
+
+    records = []
+    with open(path_manifest, 'a') as manifest:
+        def _record(i: int, dcm_folder: Path, seconds: float, error: Optional[str]):
+            record = {'folder': str(dcm_folder), 'status': 'ok' if error is None else 'failed',
+                      'seconds': round(seconds, 3), 'error': error}
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()  # Keep the manifest valid if the run is interrupted
+            records.append(record)
+            instrumentation.emit('dcm2nii.convert_folder', seconds, folder=record['folder'], status=record['status'])
+            status = f'{seconds:.1f}s' if error is None else f'FAILED after {seconds:.1f}s: {error}'
+            print(f'{i + 1}/{len(todo)} {dcm_folder} {status}')
+
+        if num_workers > 0:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                futures = {}
+                for dcm_folder in todo:
+                    save_dcm_folder = __prepare_save_dir(path_read_dicom, dcm_folder, path_save_nii)
+                    future = pool.submit(__convert_folder, dcm_folder, save_dcm_folder, compression_level)
+                    futures[future] = dcm_folder
+                for i, future in enumerate(as_completed(futures)):
+                    _record(i, futures[future], *future.result())
+        else:
+            for i, dcm_folder in enumerate(todo):  # Iterate
+                save_dcm_folder = __prepare_save_dir(path_read_dicom, dcm_folder, path_save_nii)  # Construct save path
+                _record(i, dcm_folder, *__convert_folder(dcm_folder, save_dcm_folder, compression_level))
+
+    failed = [r for r in records if r['status'] == 'failed']
+    total = sum(r['seconds'] for r in records)
+    print(f'Converted {len(records) - len(failed)}/{len(records)} folders in {total:.1f}s of conversion time')
+    for r in failed:
+        print(f'Failed: {r["folder"]} - {r["error"]}')
+
+    return records
 
 
 if __name__ == '__main__':
@@ -1,39 +1,187 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pydicom
 
+from common_utils import dicom_index as dcm_index
+from common_utils import instrumentation
+from common_utils import npy_shards
 from common_utils import preprocessor
 from common_utils.sort_DCM import sort_DCM_filenames
 
+LAYOUTS = ("volume", "shards", "slices")
 
-def dcm2npy(path_read_dicom: Path, path_save_npy: Path, normalize: bool = True):
-    dcm_files = list(path_read_dicom.glob("*.MRDC.*"))
-    if len(dcm_files) == 0:
-        dcm_files = list(path_read_dicom.glob("*.IMA"))
+
+def dcm2npy(
+        path_read_dicom: Path, path_save_npy: Path, normalize: bool = True, dicom_index: dcm_index.DicomIndex = None
+):
+    if dicom_index is not None:  # Sorted series from a prebuilt index
+        dcm_files = dcm_index.get_series_files(dicom_index, path_read_dicom)
     else:
-        dcm_files = sort_DCM_filenames(dcm_files)  # Sort DICOMs
+        dcm_files = list(path_read_dicom.glob("*.MRDC.*"))
+        if len(dcm_files) == 0:
+            dcm_files = list(path_read_dicom.glob("*.IMA"))
+        else:
+            dcm_files = sort_DCM_filenames(dcm_files)  # Sort DICOMs
 
     if not path_save_npy.exists():
         path_save_npy.mkdir(parents=False)
 
+    vol = __read_volume(dcm_files, normalize)
+    with instrumentation.stage("dcm2npy.save", layout="slices") as s:
+        __save_slices(vol, dcm_files, path_save_npy)
+        s.add_bytes(vol.nbytes)
+
+
+def __read_volume(dcm_files: list, normalize: bool, dtype=None) -> np.ndarray:
     # Convert individual DICOM files into a 3D Numpy vol
-    vol = []
-    for d in dcm_files:
-        dcm = pydicom.dcmread(str(d))
-        dcm = dcm.pixel_array
+    with instrumentation.stage("dcm2npy.read", n_files=len(dcm_files)) as s:
+        vol = []
+        for d in dcm_files:
+            dcm = pydicom.dcmread(str(d))
+            dcm = dcm.pixel_array
 
-        vol.append(dcm)
-    vol = np.stack(vol, axis=-1)
+            vol.append(dcm)
+        vol = np.stack(vol, axis=-1)
+        s.add_bytes(vol.nbytes)
 
-    if normalize:
-        vol = preprocessor.normalize_volume(vol)
+    with instrumentation.stage("dcm2npy.normalize") as s:
+        if normalize:
+            vol = preprocessor.normalize_volume(vol, dtype=dtype)
+        elif dtype is not None:
+            vol = vol.astype(dtype)
+        s.add_bytes(vol.nbytes)
+    return vol
 
+
+def __save_slices(vol: np.ndarray, dcm_files: list, path_save_npy: Path):
+    # Legacy layout, one .npy per slice named after its DICOM file
+    path_save_npy.mkdir(parents=True, exist_ok=True)
+    stems = [d.stem for d in dcm_files]
+    unique_stems = len(set(stems)) == len(stems)  # *.MRDC.<n> files all share the stem *.MRDC
     for i, d in enumerate(dcm_files):
-        path_save = path_save_npy / (d.stem + ".npy")
+        path_save = path_save_npy / ((d.stem if unique_stems else d.name) + ".npy")
         np.save(arr=vol[..., i], file=str(path_save))
 
 
+def __convert_series(
+        dcm_files: list, path_save: Path, layout: str, normalize: bool, shard_size: int, dtype
+) -> Tuple[float, Optional[str]]:
+    # Runs in a worker process, returns (seconds, error)
+    start = time.perf_counter()
+    try:
+        vol = __read_volume(dcm_files, normalize, dtype)
+        with instrumentation.stage("dcm2npy.save", layout=layout) as s:
+            if layout == "volume":
+                path_save.parent.mkdir(parents=True, exist_ok=True)
+                npy_shards.save_volume(vol, path_save.with_name(path_save.name + ".npy"))
+            elif layout == "shards":
+                npy_shards.save_shards(vol, path_save, shard_size=shard_size)
+            else:
+                __save_slices(vol, dcm_files, path_save)
+            s.add_bytes(vol.nbytes)
+    except Exception as e:
+        return time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return time.perf_counter() - start, None
+
+
+def dcm2npy_dataset(
+        path_read_root: Path,
+        path_save_root: Path,
+        layout: str = "volume",
+        normalize: bool = True,
+        shard_size: int = 64,
+        num_workers: int = 0,
+        dicom_index: dcm_index.DicomIndex = None,
+        dtype=None,
+) -> List[dict]:
+    """
+    Converts every DICOM series in the tree at `path_read_root`, mirroring its sub-folders in `path_save_root`. Folders
+    holding several series get one output per series, suffixed with its SeriesInstanceUID.
+
+    Parameters
+    ----------
+    path_read_root : Path
+        Any tree of DICOM folders.
+    path_save_root : Path
+        Output folder.
+    layout : str, default="volume"
+        "volume" writes each series as one Fortran ordered `<folder>.npy`, so every slice range is contiguous on disk.
+        "shards" writes a `<folder>/` of `shard_size` slice shards and an `index.json`, see `npy_shards.save_shards`.
+        "slices" writes a `<folder>/` of one .npy per slice, as `dcm2npy` does.
+    normalize : bool, default=True
+        Whether to normalize each volume to [0, 1].
+    shard_size : int, default=64
+        Slices per shard for layout="shards".
+    num_workers : int, default=0
+        Number of processes decoding series in parallel. 0 converts series sequentially in this process.
+    dicom_index : DicomIndex, optional
+        Prebuilt index of `path_read_root`. Built with `dicom_index.index_dicom_tree` when not given.
+    dtype : np.dtype, optional
+        dtype of the saved volumes. Defaults to float64 when normalizing, else the DICOM pixel dtype.
+
+    Returns
+    -------
+    records : list
+        One record per series with its output path, status, seconds and error.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {LAYOUTS}, got {layout}")
+
+    if dicom_index is None:
+        print("Indexing DICOM series...")
+        dicom_index = dcm_index.index_dicom_tree(path_read_root, num_workers=num_workers)
+    print(f"Found {len(dicom_index.series)} series in {len(dicom_index.folders)} folders")
+    for path_dicom, error in sorted(dicom_index.unreadable.items()):
+        print(f"Skipped unreadable {path_dicom} - {error}")
+
+    path_read_root = Path(os.path.abspath(path_read_root))
+    jobs = []
+    for folder, uids in sorted(dicom_index.folders.items()):
+        for uid in uids:
+            path_save = path_save_root / folder.relative_to(path_read_root)
+            if len(uids) > 1:
+                path_save = path_save / uid
+            if path_save == path_save_root:  # Series directly in path_read_root
+                path_save = path_save_root / path_read_root.name
+            dcm_files = [s.path for s in dicom_index.series[uid]]
+            jobs.append((dcm_files, path_save))
+
+    records = []
+
+    def _record(i: int, path_save: Path, seconds: float, error: Optional[str]):
+        record = {"path": str(path_save), "status": "ok" if error is None else "failed",
+                  "seconds": round(seconds, 3), "error": error}
+        records.append(record)
+        # Series converted in worker processes report no stages of their own, only this total
+        instrumentation.emit("dcm2npy.convert_series", seconds, path=record["path"], status=record["status"])
+        status = f"{seconds:.1f}s" if error is None else f"FAILED after {seconds:.1f}s: {error}"
+        print(f"{i + 1}/{len(jobs)} {path_save} {status}")
+
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = {
+                pool.submit(__convert_series, dcm_files, path_save, layout, normalize, shard_size, dtype): path_save
+                for dcm_files, path_save in jobs
+            }
+            for i, future in enumerate(as_completed(futures)):
+                _record(i, futures[future], *future.result())
+    else:
+        for i, (dcm_files, path_save) in enumerate(jobs):
+            _record(i, path_save, *__convert_series(dcm_files, path_save, layout, normalize, shard_size, dtype))
+
+    failed = [r for r in records if r["status"] == "failed"]
+    print(f"Converted {len(records) - len(failed)}/{len(records)} series")
+    for r in failed:
+        print(f"Failed: {r['path']} - {r['error']}")
+
+    return records
+
+
 if __name__ == "__main__":
     path_read_dicom = Path(
         r"D:\CU Data\Source\ArtifactID\artifactID_Siemens\20211103_KSR\T1_MPRAGE_(SEGMENT_1)_MOTION_0006"
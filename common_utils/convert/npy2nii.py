@@ -9,11 +9,11 @@ def main(path_save_nii: Path, npy: np.ndarray = np.array([]), path_read_npy: Pat
     Save `npy` as a NIFTI at `path_save_nii`, or load from `path_read_npy` and save it as a NIFTI at `path_save_nii`.
 
     """
-    if path_read_npy != Path() and npy == np.array([]):  # Load numpy
+    if path_read_npy != Path() and npy.size == 0:  # Load numpy
         npy = np.load(str(path_read_npy))
-    elif path_read_npy == Path() and npy == np.array([]):
+    elif path_read_npy == Path() and npy.size == 0:
         raise ValueError('Either npy or path_read_npy must be passed.')
-    elif path_read_npy != Path() and npy != np.array([]):
+    elif path_read_npy != Path() and npy.size != 0:
         raise ValueError('Either npy or path_read_npy must be passed, not both.')
 
     # Save as NIFTI
@@ -0,0 +1,197 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import nibabel as nb
+import numpy as np
+
+from common_utils import data_loader
+from common_utils import dicom_index as dcm_index
+from common_utils import instrumentation
+from common_utils import orientation
+from common_utils import volume_store
+
+# File suffixes dropped from output names, longest first
+VOLUME_SUFFIXES = (".nii.gz", ".nii", ".npy")
+
+
+def __store_name(path_read: Path) -> str:
+    # Folder names are kept whole, DICOM series folders are often UIDs such as 1.3.12.2...
+    name = path_read.name
+    if path_read.is_file():
+        for suffix in VOLUME_SUFFIXES:
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+    return name
+
+
+def __source_dtype(path_read: Path, data_format: str, nifti_dataset: str) -> Optional[np.dtype]:
+    # dtype the volume is stored in, so integer NIFTI is not stored as float64. None keeps the loader's default
+    if data_format == "nifti":
+        nii = nb.load(str(path_read))
+        if nii.dataobj.slope != 1 or nii.dataobj.inter != 0:  # Scaled to float on reading
+            return None
+        if orientation.get_orientation(nifti_dataset)[0].resize is not None:  # Interpolated values are not integers
+            return None
+        return nii.get_data_dtype()
+    return None  # npy keeps its stored dtype, DICOM is read with keep_integer
+
+
+def __convert_volume(
+        path_read: Path, path_save_store: Path, data_format: str, nifti_dataset: str, chunks: Optional[tuple],
+        codec: str, level: int
+) -> Tuple[float, Optional[dict], Optional[str]]:
+    # Runs in a worker process, returns (seconds, metadata, error)
+    start = time.perf_counter()
+    try:
+        metadata = vol2store(path_read, path_save_store, data_format, nifti_dataset=nifti_dataset, chunks=chunks,
+                             codec=codec, level=level)
+    except Exception as e:
+        return time.perf_counter() - start, None, f"{type(e).__name__}: {e}"
+    return time.perf_counter() - start, metadata, None
+
+
+def vol2store(
+        path_read: Path,
+        path_save_store: Path,
+        data_format: str,
+        nifti_dataset: str = "",
+        chunks: Optional[tuple] = None,
+        codec: str = "zlib",
+        level: int = 1,
+) -> dict:
+    """
+    Converts a DICOM series, NIFTI or npy volume to a chunked, compressed volume store, readable with
+    `data_loader.load_data(path_save_store, "store", ...)`. Values are stored as loaded, without normalizing, in the
+    dtype of the source: DICOM keeps its integer pixel values and rescale (`keep_integer=True`), NIFTI without
+    scl_slope/scl_inter scaling and npy their stored dtype. Integer volumes are a quarter of the size of float64 before
+    compression. Stores hold the volume in the orientation `data_loader.load_data(path_read, data_format,
+    nifti_dataset=nifti_dataset)` returns it in, and are loaded without `nifti_dataset` as no orientation is applied
+    to them again.
+
+    Parameters
+    ----------
+    path_read : Path
+        DICOM folder, NIFTI file or npy file/folder.
+    path_save_store : Path
+        Store folder to write.
+    data_format : str
+        One of nifti, dicom or npy.
+    nifti_dataset : str, default=""
+        Dataset-contrast name selecting the orientation, padding and resizing applied to NIFTI volumes before storing,
+        see `data_loader.load_nifti`. The default stores NIFTI volumes in their on-disk orientation.
+    chunks : tuple, optional
+        Chunk shape, see `volume_store.save_store`. Defaults to one slice per chunk.
+    codec : str, default="zlib"
+        One of zlib, lz4 or none.
+    level : int, default=1
+        Compression level of the codec.
+
+    Returns
+    -------
+    metadata : dict
+        Contents of the store's `store.json`.
+    """
+    vol = data_loader.load_data(path_read, data_format, nifti_dataset=nifti_dataset, normalize=False,
+                                dtype=__source_dtype(path_read, data_format, nifti_dataset),
+                                keep_integer=data_format == "dicom")
+    metadata = volume_store.save_store(vol, path_save_store, chunks=chunks, codec=codec, level=level)
+    print(f"{path_save_store}: {vol.nbytes / 2 ** 20:.1f} MB -> {metadata['nbytes_stored'] / 2 ** 20:.1f} MB")
+    return metadata
+
+
+def vol2store_dataset(
+        paths_read: Iterable[Path],
+        path_read_root: Path,
+        path_save_root: Path,
+        data_format: str,
+        nifti_dataset: str = "",
+        chunks: Optional[tuple] = None,
+        codec: str = "zlib",
+        level: int = 1,
+        num_workers: int = 0,
+) -> List[dict]:
+    """
+    Converts every volume of `paths_read` with `vol2store`, mirroring its path relative to `path_read_root` in
+    `path_save_root`. The .nii.gz, .nii and .npy suffixes of files are dropped (e.g. sub/T1.nii.gz -> sub/T1), folder
+    names are kept as they are.
+
+    Parameters
+    ----------
+    paths_read : iterable of Path
+        DICOM folders, NIFTI files or npy files/folders under `path_read_root`.
+    path_read_root : Path
+        Root of `paths_read`.
+    path_save_root : Path
+        Output folder.
+    data_format : str
+        One of nifti, dicom or npy.
+    nifti_dataset : str, default=""
+        See `vol2store`.
+    chunks : tuple, optional
+        Chunk shape, see `volume_store.save_store`.
+    codec : str, default="zlib"
+        One of zlib, lz4 or none.
+    level : int, default=1
+        Compression level of the codec.
+    num_workers : int, default=0
+        Number of processes converting volumes in parallel. 0 converts volumes sequentially in this process.
+
+    Returns
+    -------
+    records : list
+        One record per volume with its output path, status, seconds, stored bytes and error.
+    """
+    jobs = []
+    for path_read in paths_read:
+        relative = path_read.relative_to(path_read_root)
+        jobs.append((path_read, path_save_root / relative.parent / __store_name(path_read)))
+
+    records = []
+
+    def _record(i: int, path_save: Path, seconds: float, metadata: Optional[dict], error: Optional[str]):
+        record = {
+            "path": str(path_save),
+            "status": "ok" if error is None else "failed",
+            "seconds": seconds,
+            "nbytes_stored": metadata["nbytes_stored"] if metadata is not None else None,
+            "error": error,
+        }
+        records.append(record)
+        instrumentation.emit("vol2store.convert_volume", seconds, nbytes=record["nbytes_stored"],
+                             path=record["path"], status=record["status"])
+        status = f"{seconds:.1f}s" if error is None else f"FAILED after {seconds:.1f}s: {error}"
+        print(f"{i + 1}/{len(jobs)} {path_save} {status}")
+
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = {
+                pool.submit(
+                    __convert_volume, path_read, path_save, data_format, nifti_dataset, chunks, codec, level
+                ): path_save
+                for path_read, path_save in jobs
+            }
+            for i, future in enumerate(as_completed(futures)):
+                _record(i, futures[future], *future.result())
+    else:
+        for i, (path_read, path_save) in enumerate(jobs):
+            result = __convert_volume(path_read, path_save, data_format, nifti_dataset, chunks, codec, level)
+            _record(i, path_save, *result)
+
+    failed = [r for r in records if r["status"] == "failed"]
+    print(f"Converted {len(records) - len(failed)}/{len(records)} volumes")
+    for r in failed:
+        print(f"Failed: {r['path']} - {r['error']}")
+
+    return records
+
+
+if __name__ == "__main__":
+    path_read_root = Path(r"D:\CU Data\Source\ArtifactID\artifactID_Siemens")
+    path_save_root = Path(r"D:\CU Data\Source\ArtifactID\artifactID_Siemens_store")
+
+    # One store per DICOM series folder (Siemens .IMA here), one slice per chunk. Files are matched with the same filter
+    # as `data_loader.glob_dicom`, so each folder found holds the files that are loaded
+    paths_read = sorted({f.parent for f in dcm_index.walk_files(path_read_root) if dcm_index.is_dicom_filename(f.name)})
+    vol2store_dataset(paths_read, path_read_root, path_save_root, "dicom")
@@ -1,33 +1,42 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Union, List, Tuple
+from typing import Iterable, Iterator, Optional, Union, List, Tuple
 
 import nibabel as nb
 import numpy as np
 import pydicom as pyd
 
 from common_utils import data_utils
+from common_utils import dicom_index as dcm_index
+from common_utils import instrumentation
+from common_utils import integer_volume
+from common_utils import npy_shards
+from common_utils import orientation
 from common_utils import preprocessor
-from common_utils.sort_DCM import sort_DCM_filenames
+from common_utils import volume_store
+from common_utils.lazy_volume import LazyVolume
+from common_utils.sort_DCM import natural_sort, sort_DCM_filenames
+from common_utils.volume_cache import VolumeCache
 
 
 def glob_dicom(path_dicom: Path) -> list:
-    # .MRDC.* + .dcm
-    dicom_files = list(path_dicom.glob("**/*.MRDC.*")) + list(
-        path_dicom.glob("**/*.dcm")
-    )
-    return dicom_files
-
-
-def glob_nifti(path_nifti: Path) -> list:
-    nifti_files = list(path_nifti.glob("**/*.nii")) + list(
-        path_nifti.glob("**/*.nii.gz")
-    )
-    return nifti_files
+    # Files `dicom_index.is_dicom_filename` accepts (.MRDC.* first, then .dcm and .IMA), gathered in a single walk of
+    # the tree, so indexed and globbed series hold the same files
+    mrdc_files = []
+    other_files = []
+    for f in dcm_index.walk_files(path_dicom):
+        if not dcm_index.is_dicom_filename(f.name):
+            continue
+        if ".MRDC." in f.name:
+            mrdc_files.append(f)
+        else:
+            other_files.append(f)
+    return mrdc_files + other_files
 
 
-def load_dicom_folder(
-        path_dicom_folder: Path, return_dicoms: bool = False
-) -> Union[np.ndarray, Tuple[np.ndarray, List]]:
+def _resolve_dicom_folder(path_dicom_folder: Path) -> Path:
     if any(
             (
                     "MRDC" in path_dicom_folder.stem,
@@ -37,102 +46,389 @@ def load_dicom_folder(
         # path_dicom_folder is a DICOM file
         # It should be parent folder instead
         path_dicom_folder = path_dicom_folder.parent
+    return path_dicom_folder
+
+
+def glob_nifti(path_nifti: Path) -> list:
+    nifti_files = list(path_nifti.glob("**/*.nii")) + list(
+        path_nifti.glob("**/*.nii.gz")
+    )
+    return nifti_files
+
+
+def _crop_key(shape: tuple, central_50pc_crop: bool = False, target_fov: Optional[int] = None) -> tuple:
+    # Index of the crops of `load_data` into a squeezed volume of `shape`: the central `target_fov` pixels in-plane
+    # and the central 50% of the slices on the last axis. 2D volumes have no slice axis to crop before loading
+    key = [slice(None)] * len(shape)
+    if target_fov is not None:
+        key[0] = preprocessor.fov_slice(shape[0], target_fov)
+        key[1] = preprocessor.fov_slice(shape[1], target_fov)
+    if central_50pc_crop and len(shape) >= 3:
+        key[-1] = data_utils.central_50pc_slice(shape[-1])
+    return tuple(key)
+
 
-    dicom_files = glob_dicom(path_dicom_folder)
-    # *.MRDC.* DICOM FILES ARE NEVER IN ALPHABETICAL ORDER!!!
-    dicom_files = sort_DCM_filenames(dicom_files)
+def _central_files(files: list) -> Tuple[list, bool]:
+    # Sorted slice files of the central 50% of slices, and whether no slice is kept (fewer than 4 slices). Then only
+    # the first file is returned, for the in-plane shape of the empty volume. A single file squeezes to 2D and is kept
+    if len(files) < 2:
+        return files, False
+    central = data_utils.central_50pc_slice(len(files))
+    if central.start == central.stop:
+        return files[:1], True
+    return files[central], False
 
-    vol = []
-    dicoms = []
-    for d in dicom_files:
-        dicom = pyd.dcmread(str(d))
-        vol.append(dicom.pixel_array)
 
-        if return_dicoms:
-            dicoms.append(dicom)
+def _read_dicom_slice(
+        path_dicom: Path, return_dicom: bool = False
+) -> Tuple[np.ndarray, Optional[pyd.Dataset], Tuple[float, float]]:
+    # Stored pixel values, the dataset if requested, and its (RescaleSlope, RescaleIntercept)
+    with instrumentation.stage("dicom.read") as s:
+        dicom = pyd.dcmread(str(path_dicom))
+        if s.enabled and "PixelData" in dicom:
+            s.add_bytes(len(dicom.PixelData))
+    with instrumentation.stage("dicom.decode") as s:
+        pixel_array = dicom.pixel_array
+        s.add_bytes(pixel_array.nbytes)
+    rescale = integer_volume.rescale_params(dicom)
+    if return_dicom:
+        return pixel_array, dicom, rescale
+    return pixel_array, None, rescale
+
+
+def _load_dicom_files_parallel(
+        dicom_files: list,
+        return_dicoms: bool,
+        num_workers: int,
+        executor: str,
+        dtype: Optional[np.dtype] = np.float64,
+        target_fov: Optional[int] = None,
+) -> Tuple[np.ndarray, List, List]:
+    """
+    Reads and decodes `dicom_files` concurrently. Each decoded slice is written straight into a preallocated float
+    volume at its sorted index, so no intermediate list of slices is built.
+
+    Parameters
+    ----------
+    dicom_files : list
+        Sorted DICOM files of one series.
+    return_dicoms : bool
+        Whether to also return the `pydicom.Dataset` of every slice.
+    num_workers : int
+        Number of workers in the pool.
+    executor : str
+        "thread" or "process". Threads write into the output directly; processes send decoded slices back.
+    dtype : np.dtype, default=np.float64
+        dtype of the returned volume. None keeps the dtype of the decoded pixel data.
+    target_fov : int, optional
+        Central in-plane size kept of every slice, see `preprocessor.crop_fov`.
+
+    Returns
+    -------
+    vol : np.ndarray
+    dicoms : list
+        `pydicom.Dataset` of every slice if `return_dicoms`, else Nones.
+    rescale : list
+        (RescaleSlope, RescaleIntercept) of every slice.
+    """
+    if executor not in ("thread", "process"):
+        raise ValueError(f"Unknown executor {executor}. Expected thread or process")
+
+    # First slice determines the in-plane shape of the preallocated volume
+    first_slice, first_dicom, first_rescale = _read_dicom_slice(dicom_files[0], return_dicoms)
+    in_plane = _crop_key(first_slice.shape, target_fov=target_fov)
+    first_slice = first_slice[in_plane]
+    vol = np.empty(first_slice.shape + (len(dicom_files),), dtype=first_slice.dtype if dtype is None else dtype)
+    vol[..., 0] = first_slice
+    dicoms = [first_dicom] + [None] * (len(dicom_files) - 1)
+    rescale = [first_rescale] + [None] * (len(dicom_files) - 1)
+
+    if executor == "thread":
+        def _read_into_vol(i: int):
+            _slice, dicoms[i], rescale[i] = _read_dicom_slice(dicom_files[i], return_dicoms)
+            vol[..., i] = _slice[in_plane]
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            # list() re-raises the first exception from any worker
+            list(pool.map(instrumentation.bind_context(_read_into_vol), range(1, len(dicom_files))))
+    else:
+        # Stages of worker processes are not reported, only the total
+        with ProcessPoolExecutor(max_workers=num_workers) as pool, instrumentation.stage("dicom.read_processes") as s:
+            chunksize = max(1, len(dicom_files) // (4 * num_workers))
+            results = pool.map(
+                _read_dicom_slice,
+                dicom_files[1:],
+                [return_dicoms] * (len(dicom_files) - 1),
+                chunksize=chunksize,
+            )
+            for i, (_slice, dicom, slice_rescale) in enumerate(results, start=1):
+                vol[..., i] = _slice[in_plane]
+                dicoms[i] = dicom
+                rescale[i] = slice_rescale
+                s.add_bytes(_slice.nbytes)
+
+    return vol, dicoms, rescale
+
+
+def load_dicom_folder(
+        path_dicom_folder: Path,
+        return_dicoms: bool = False,
+        num_workers: int = 0,
+        executor: str = "thread",
+        dicom_index: dcm_index.DicomIndex = None,
+        dtype: np.dtype = np.float64,
+        central_50pc_crop: bool = False,
+        target_fov: Optional[int] = None,
+        keep_integer: bool = False,
+) -> Union[np.ndarray, Tuple[np.ndarray, List]]:
+    """
+    Parameters
+    ----------
+    path_dicom_folder : Path
+        DICOM folder, or any DICOM file inside it.
+    return_dicoms : bool, default=False
+        Whether to also return the `pydicom.Dataset` of every slice.
+    num_workers : int, default=0
+        Number of workers used to read and decode slices concurrently. 0 reads slices sequentially.
+    executor : str, default="thread"
+        Pool used when `num_workers > 0`: "thread" or "process". Both give results identical to the sequential path.
+    dicom_index : DicomIndex, optional
+        Index built by `dicom_index.index_dicom_tree`. The sorted series is looked up in it instead of globbing and
+        sorting filenames.
+    dtype : np.dtype, default=np.float64
+        dtype of the returned volume, e.g. np.float32 to halve memory.
+    central_50pc_crop : bool, default=False
+        Whether to read and decode only the central 50% of the sorted files, see `data_utils.crop_central_50pc`.
+    target_fov : int, optional
+        Central in-plane size kept of every slice as it is decoded, see `preprocessor.crop_fov`.
+    keep_integer : bool, default=False
+        Whether to keep the stored integer pixel values (e.g. uint16) instead of casting to `dtype`. Returns an
+        `integer_volume.IntegerVolume` carrying the RescaleSlope/RescaleIntercept of the series, which must be the same
+        for every slice.
+    """
+    with instrumentation.stage("dicom.list_files"):
+        path_dicom_folder = _resolve_dicom_folder(path_dicom_folder)
+
+        if dicom_index is not None:
+            dicom_files = dcm_index.get_series_files(dicom_index, path_dicom_folder)
+        else:
+            dicom_files = glob_dicom(path_dicom_folder)
+            # *.MRDC.* DICOM FILES ARE NEVER IN ALPHABETICAL ORDER!!!
+            dicom_files = sort_DCM_filenames(dicom_files)
+
+    no_slices = False
+    if central_50pc_crop:  # Only the central files are read and decoded
+        dicom_files, no_slices = _central_files(dicom_files)
+
+    if num_workers > 0:
+        vol, dicoms, rescale = _load_dicom_files_parallel(
+            dicom_files, return_dicoms, num_workers, executor, None if keep_integer else dtype, target_fov
+        )
+    else:
+        vol = []
+        dicoms = []
+        rescale = []
+        for d in dicom_files:
+            _slice, dicom, slice_rescale = _read_dicom_slice(d, return_dicoms)
+            vol.append(_slice[_crop_key(_slice.shape, target_fov=target_fov)])
+            rescale.append(slice_rescale)
 
-    vol = np.stack(vol, axis=-1).astype(np.float)
+            if return_dicoms:
+                dicoms.append(dicom)
+
+        with instrumentation.stage("dicom.stack") as s:
+            vol = np.stack(vol, axis=-1)
+            if not keep_integer:
+                vol = vol.astype(dtype)
+            s.add_bytes(vol.nbytes)
+
+    if keep_integer:
+        vol = integer_volume.IntegerVolume.from_slices(vol, rescale)
+    if no_slices:
+        vol, dicoms = vol[..., :0], []
 
     if return_dicoms:
         return vol, dicoms
     return vol
 
 
-def load_nifti(path_nifti: Path, nifti_dataset: str) -> np.ndarray:
+def load_nifti_lazy(path_nifti: Path, nifti_dataset: str, dtype: np.dtype = np.float64) -> LazyVolume:
+    """
+    Opens a NIFTI without reading its data. The dataset-contrast specific orientation is composed into a single index
+    transform that is only applied to the slices that are requested, and padding is virtual.
+    """
     nii = nb.load(str(path_nifti))
-    vol = nii.get_data().squeeze()
-
-    # Dataset-contrast specific preprocessing
-    if nifti_dataset == "HCP-T2":
-        vol = np.moveaxis(vol, 2, 1)
-    elif nifti_dataset == "HCP-T1":
-        vol = np.rot90(vol, -1)
-        vol = np.fliplr(vol)
-    elif nifti_dataset in ["IXI-T1", "IXI_3T-T1", "IXI_15T-T1"]:
-        vol = np.rot90(vol, 1)
-    elif nifti_dataset == "HCP-T1-BET":
-        vol = np.rot90(vol, -1, axes=(0, 1))
-        vol = np.fliplr(vol)
-    elif nifti_dataset == "IXI-T1-BET":
-        vol = np.rot90(vol, 1, axes=(0, 1))
-    elif nifti_dataset == "HCP-T1-FLIRT":
-        vol = np.moveaxis(vol, (0, 1, 2), (2, 1, 0))
-        vol = np.fliplr(vol)
-        vol = np.flipud(vol)
-        vol = np.pad(vol, ((37, 37), (19, 19), (0, 0)))
-    elif nifti_dataset == "IXI-T1-FLIRT":
-        vol = np.moveaxis(vol, (0, 1, 2), (2, 1, 0))
-        vol = np.fliplr(vol)
-        vol = np.flipud(vol)
-        vol = np.pad(vol, ((37, 37), (19, 19), (0, 0)))
-    elif nifti_dataset == "HCP-T1-FLIRT-BET":
-        vol = np.moveaxis(vol, 0, 2)
-        vol = np.rot90(vol, axes=(0, 1))
-        vol = np.fliplr(vol)
-        vol = np.pad(vol, ((37, 37), (19, 19), (0, 0)))
-    elif nifti_dataset == "IXI-T1-FLIRT-BET":
-        vol = np.moveaxis(vol, 0, 2)
-        vol = np.rot90(vol, axes=(0, 1))
-        vol = np.fliplr(vol)
-        vol = np.pad(vol, ((37, 37), (19, 19), (0, 0)))
-    elif nifti_dataset == "MS_SEG-FLAIR":
-        vol = np.rot90(vol, 1)
-        vol = preprocessor.resize_vol(vol, 256)
-    elif nifti_dataset == "ADNI_GO2-T1-FLIRT-BET":
-        vol = np.moveaxis(vol, 0, 2)
-        vol = np.rot90(vol, axes=(0, 1))
-        vol = np.fliplr(vol)
-        vol = np.pad(vol, ((37, 37), (19, 19), (0, 0)))
-    elif nifti_dataset == "ADNI-T2star":
-        vol = np.rot90(vol, 1)
-
-    vol = vol.astype(np.float)  # Convert from np.memmap
+    dataobj = nii.dataobj
+    squeezed_shape = tuple(n for n in dataobj.shape if n != 1)
+    if squeezed_shape != dataobj.shape:
+        dataobj = dataobj.reshape(squeezed_shape)
+
+    spec, perm, flips = orientation.get_orientation(nifti_dataset, ndim=len(squeezed_shape))
+    return LazyVolume(dataobj, perm=perm, flips=flips, pad=spec.pad, resize=spec.resize, dtype=dtype)
+
+
+def load_nifti(
+        path_nifti: Path,
+        nifti_dataset: str,
+        lazy: bool = False,
+        dtype: np.dtype = np.float64,
+        central_50pc_crop: bool = False,
+        target_fov: Optional[int] = None,
+) -> Union[np.ndarray, LazyVolume]:
+    if lazy:
+        return load_nifti_lazy(path_nifti, nifti_dataset, dtype=dtype)
+
+    if central_50pc_crop or target_fov is not None:
+        # Only the cropped slices and in-plane range are read from disk and oriented
+        with instrumentation.stage("nifti.read_cropped") as s:
+            vol = load_nifti_lazy(path_nifti, nifti_dataset, dtype=dtype)
+            vol = vol[_crop_key(vol.shape, central_50pc_crop, target_fov)]
+            s.add_bytes(vol.nbytes)
+        return vol
+
+    with instrumentation.stage("nifti.open"):
+        nii = nb.load(str(path_nifti))
+        vol = np.asanyarray(nii.dataobj).squeeze()
 
+    # Dataset-contrast specific preprocessing, see `orientation.NIFTI_ORIENTATIONS` and
+    # `orientation.register_nifti_dataset`. Orientation, padding and the cast from np.memmap happen in one pass, so
+    # for uncompressed files "nifti.orient" includes reading the data from disk
+    with instrumentation.stage("nifti.orient", nifti_dataset=nifti_dataset) as s:
+        spec, perm, flips = orientation.get_orientation(nifti_dataset, ndim=vol.ndim)
+        if spec.resize is not None:
+            vol = orientation.apply_orientation(vol, perm, flips)
+            vol = preprocessor.resize_vol(vol, spec.resize)  # Resize on the source dtype
+            vol = vol.astype(dtype)
+        else:
+            vol = orientation.orient_into(vol, perm, flips, pad=spec.pad, dtype=dtype)
+        s.add_bytes(vol.nbytes)
     return vol
 
 
-def load_numpy(path_numpy: Path) -> np.ndarray:
-    if path_numpy.is_dir():
-        # Load folder as a numpy volume
-        npy = []
-        for f in path_numpy.glob("*.npy"):
-            each_npy = np.load(str(f))
-            npy.append(each_npy)
-        npy = np.stack(npy, axis=-1)
-        return npy
-    return np.load(str(path_numpy))  # Load single numpy
+def load_numpy(
+        path_numpy: Path, central_50pc_crop: bool = False, target_fov: Optional[int] = None
+) -> np.ndarray:
+    """
+    Loads a .npy file, a folder of per-slice .npy files or a sharded folder written by `dcm2npy_dataset`. With
+    `central_50pc_crop` or `target_fov` only the cropped range is read, through a memmap or the shard index.
+    """
+    crop = central_50pc_crop or target_fov is not None
+    with instrumentation.stage("npy.read") as s:
+        if path_numpy.is_dir() and npy_shards.is_sharded(path_numpy):
+            # Sharded volume written by `dcm2npy_dataset`, only the shards overlapping the central slices are read
+            shape = tuple(npy_shards.read_index(path_numpy)["shape"])
+            if central_50pc_crop and len(shape) >= 3 and 1 not in shape:
+                central = data_utils.central_50pc_slice(shape[-1])
+                npy = npy_shards.load_shards(path_numpy, central.start, central.stop)
+                if target_fov is not None:
+                    npy = npy[_crop_key(npy.shape, target_fov=target_fov)].copy()
+            else:
+                npy = npy_shards.load_shards(path_numpy)
+                if crop:
+                    npy = npy.squeeze()
+                    npy = npy[_crop_key(npy.shape, central_50pc_crop, target_fov)].copy()
+        elif path_numpy.is_dir():
+            # Load folder as a numpy volume, slices in natural file name order
+            files = natural_sort(list(path_numpy.glob("*.npy")))
+            npy = load_numpy_from_list(files, central_50pc_crop=central_50pc_crop, target_fov=target_fov)
+        elif crop:
+            npy = np.load(str(path_numpy), mmap_mode="r").squeeze()
+            npy = np.array(npy[_crop_key(npy.shape, central_50pc_crop, target_fov)])
+        else:
+            npy = np.load(str(path_numpy))  # Load single numpy
+        s.add_bytes(npy.nbytes)
+    return npy
 
 
-def load_numpy_from_list(files: list) -> np.ndarray:
-    npy = []
-    for f in files:
-        npy_noisy = np.load(str(f))
-        npy.append(npy_noisy)
-    npy = np.stack(npy, axis=-1)
+def load_numpy_from_list(
+        files: list, central_50pc_crop: bool = False, target_fov: Optional[int] = None
+) -> np.ndarray:
+    # Slices are read straight into a preallocated volume instead of stacking a list of copies. Crops select the
+    # central files and the central in-plane range of each memmap
+    no_slices = False
+    if central_50pc_crop:
+        files, no_slices = _central_files(files)
+    first = np.load(str(files[0]), mmap_mode="r")
+    in_plane = _crop_key(first.shape, target_fov=target_fov) if target_fov is not None else ()
+    first = first[in_plane]
+    npy = np.empty(first.shape + (len(files),), dtype=first.dtype)
+    for i, f in enumerate(files):
+        npy[..., i] = np.load(str(f), mmap_mode="r")[in_plane]
 
+    if no_slices:
+        return npy[..., :0]
     return npy
 
 
+def load_store(
+        path_store: Path,
+        slice_range: Union[slice, Tuple[int, int], None] = None,
+        central_50pc_crop: bool = False,
+        target_fov: Optional[int] = None,
+        num_workers: int = 0,
+        dtype: np.dtype = np.float64,
+        keep_integer: bool = False,
+) -> np.ndarray:
+    """
+    Loads a chunked volume store written by `volume_store.save_store` as `dtype`. Only the chunks overlapping
+    `slice_range` (slices [start, stop) of the last axis) and the crops are read and decoded. The central 50% crop
+    applies to the slices of `slice_range`. With `keep_integer` the stored values of an integer store are returned as
+    an `integer_volume.IntegerVolume`, as `load_dicom_folder` does.
+    """
+    vol = _read_store(path_store, slice_range, central_50pc_crop, target_fov, num_workers)
+    if keep_integer:
+        if not np.issubdtype(vol.dtype, np.integer):
+            raise ValueError(f"keep_integer requires a store of integers, got {vol.dtype}")
+        return vol if isinstance(vol, integer_volume.IntegerVolume) else integer_volume.IntegerVolume(vol)
+
+    with instrumentation.stage("cast") as s:
+        vol = np.asarray(vol).astype(dtype, copy=False)
+        s.add_bytes(vol.nbytes)
+    return vol
+
+
+def _read_store(
+        path_store: Path,
+        slice_range: Union[slice, Tuple[int, int], None],
+        central_50pc_crop: bool,
+        target_fov: Optional[int],
+        num_workers: int,
+) -> np.ndarray:
+    store = volume_store.VolumeStore(path_store, num_workers=num_workers)
+    if slice_range is not None and not isinstance(slice_range, slice):
+        slice_range = slice(*slice_range)
+    slices = range(store.shape[-1])[slice_range if slice_range is not None else slice(None)]
+
+    if 1 in store.shape[:-1] or len(slices) == 1:  # Crops are defined on the squeezed volume
+        vol = store[..., slice(slices.start, slices.stop if slices.stop >= 0 else None, slices.step)].squeeze()
+        return vol[_crop_key(vol.shape, central_50pc_crop, target_fov)]
+
+    key = list(_crop_key(store.shape[:-1] + (len(slices),), central_50pc_crop, target_fov))
+    slices = slices[key[-1]]
+    key[-1] = slice(slices.start, slices.stop if slices.stop >= 0 else None, slices.step)
+    return store[tuple(key)]
+
+
+def _source_files(
+        path_data: Union[Path, list], data_format: str, dicom_index: dcm_index.DicomIndex = None
+) -> list:
+    # Files whose content determines the loaded volume, used to fingerprint cache entries
+    if data_format == "dicom":
+        path_data = _resolve_dicom_folder(path_data)
+        if dicom_index is not None:
+            return dcm_index.get_series_files(dicom_index, path_data)
+        return glob_dicom(path_data)
+    elif data_format in ("npy", "numpy") and path_data.is_dir():
+        if npy_shards.is_sharded(path_data):
+            return [path_data / npy_shards.INDEX_FILENAME] + list(path_data.glob("*.npy"))
+        return natural_sort(list(path_data.glob("*.npy")))
+    elif data_format == "list":
+        return list(path_data)
+    elif data_format == "store":
+        return [path_data / volume_store.METADATA_FILENAME]  # Rewritten last whenever the store is saved
+    return [path_data]
+
+
 def load_data(
         path_data: Union[Path, list],
         data_format: str,
@@ -141,32 +437,172 @@ def load_data(
         nifti_dataset: str = "",
         return_dicoms: bool = False,
         target_size: int = None,
+        num_workers: int = 0,
+        executor: str = "thread",
+        dicom_index: dcm_index.DicomIndex = None,
+        cache: VolumeCache = None,
+        lazy: bool = False,
+        dtype: np.dtype = None,
+        target_fov: int = None,
+        crop_first: bool = False,
+        keep_integer: bool = False,
+        slice_range: Union[slice, Tuple[int, int], None] = None,
 ):
+    """
+    Parameters
+    ----------
+    path_data : Path or list
+        NIFTI file, DICOM folder (or file), npy file or folder, or a list of npy files when `data_format="list"`.
+    data_format : str
+        One of nifti, dicom, npy, list or store (see `volume_store`).
+    normalize : bool
+        Whether to min-max normalize the volume.
+    central_50pc_crop : bool, default=False
+        Whether to keep only the central 50% of slices. Unless normalizing, only those slices are read and decoded
+        (DICOM files of the sorted series, NIFTI or npy slices through a memmap); see `crop_first`.
+    nifti_dataset : str, default=""
+        Dataset-contrast name selecting the orientation applied by `load_nifti`.
+    return_dicoms : bool, default=False
+        Whether to also return the `pydicom.Dataset` of every slice. Only for DICOM.
+    target_size : int, optional
+        In-plane size to resize every slice to.
+    num_workers : int, default=0
+        Number of workers used to decode DICOM slices or store chunks concurrently. See `load_dicom_folder`.
+    executor : str, default="thread"
+        Pool used when `num_workers > 0`: "thread" or "process".
+    dicom_index : DicomIndex, optional
+        Prebuilt DICOM index to look up the sorted series in.
+    cache : VolumeCache, optional
+        On-disk cache of the final preprocessed volume. On a hit the cached array is returned memory-mapped and no
+        decoding or preprocessing happens. Bypassed when `return_dicoms=True`.
+    lazy : bool, default=False
+        Only for NIFTI. Returns a `LazyVolume` that reads and orients slices only when they are indexed. Cannot be
+        combined with `normalize` or `target_size`; `central_50pc_crop` reads just the central slices.
+    dtype : np.dtype, optional
+        dtype kept through loading, resizing and normalization, e.g. np.float32. By default DICOM, NIFTI and store are
+        loaded as float64 and npy keeps its stored dtype.
+    target_fov : int, optional
+        Central in-plane size to crop every slice to, as `preprocessor.crop_fov`, after resizing and normalization.
+        Without `normalize` or `target_size` only that range is kept of every decoded slice; see `crop_first`.
+    crop_first : bool, default=False
+        Whether to crop while loading even when the result differs from cropping last: the central 50% of slices when
+        normalizing, and `target_fov` when normalizing or resizing. Normalization then uses the min and max of the
+        cropped volume instead of the whole volume, and `target_size` resizes the cropped field of view. Resizing is
+        per slice, so the central slices are always cropped first without normalization, with identical results.
+    keep_integer : bool, default=False
+        Only for DICOM and integer stores. Keeps the stored integer pixel values instead of casting to float, see
+        `load_dicom_folder`.
+        Without `target_size` or `normalize` an `integer_volume.IntegerVolume` is returned, 4x smaller than float64.
+        Normalization reads the integers directly and only writes float output; resizing casts to float first.
+        Bypasses `cache`.
+    slice_range : slice or tuple, optional
+        Only for store. Slices [start, stop) of the last axis to load; only their chunks are read and decoded.
+
+    Every step is reported as a stage to the hooks of `instrumentation.instrument`, e.g. "dicom.read", "resize" and
+    "normalize", at no cost when no hook is active.
+    """
     if not isinstance(path_data, (Path, list)):
         path_data = Path(path_data)
 
+    if lazy and (data_format != "nifti" or normalize or target_size is not None):
+        raise ValueError("lazy loading is only supported for nifti without normalize or target_size")
+
+    if keep_integer and data_format not in ("dicom", "store"):
+        raise ValueError("keep_integer is only supported for dicom and store")
+    if slice_range is not None and data_format != "store":
+        raise ValueError("slice_range is only supported for store")
+
+    use_cache = cache is not None and not return_dicoms and not lazy and not keep_integer
+    loader_dtype = np.float64 if dtype is None else dtype
+    if use_cache:
+        cache_key = cache.key(
+            _source_files(path_data, data_format, dicom_index),
+            data_format=data_format,
+            normalize=normalize,
+            central_50pc_crop=central_50pc_crop,
+            nifti_dataset=nifti_dataset,
+            target_size=target_size,
+            dtype=dtype,
+            target_fov=target_fov,
+            crop_first=crop_first,
+            slice_range=slice_range,
+        )
+        with instrumentation.stage("cache.get") as s:
+            data = cache.get(cache_key)
+            s.annotate(hit=data is not None)
+        if data is not None:
+            return data
+
+    # Crops are pushed down into the loaders, which read only the cropped range, where that gives the same result. The
+    # central slices commute with everything but normalization, whose min and max span the whole volume. The field of
+    # view also changes what resizing interpolates
+    crop_central_on_load = central_50pc_crop and (crop_first or not normalize) and not lazy
+    crop_fov_on_load = (
+            target_fov is not None and (crop_first or not (normalize or target_size is not None)) and not lazy
+    )
+    crops = {"central_50pc_crop": crop_central_on_load, "target_fov": target_fov if crop_fov_on_load else None}
+
     if data_format == "nifti":  # Load NIFTI
-        data = load_nifti(path_data, nifti_dataset=nifti_dataset)
+        data = load_nifti(path_data, nifti_dataset=nifti_dataset, lazy=lazy, dtype=loader_dtype, **crops)
     elif data_format == "dicom":  # Load DICOM
-        data = load_dicom_folder(path_data, return_dicoms)
+        data = load_dicom_folder(
+            path_data,
+            return_dicoms,
+            num_workers=num_workers,
+            executor=executor,
+            dicom_index=dicom_index,
+            dtype=loader_dtype,
+            keep_integer=keep_integer,
+            **crops,
+        )
         if return_dicoms:  # Return DICOM files also
             data, dicoms = data
     elif data_format in ("npy", "numpy"):  # Load npy
-        data = load_numpy(path_data)
+        data = load_numpy(path_data, **crops)
     elif data_format == "list":
-        data = load_numpy_from_list(path_data)
+        with instrumentation.stage("npy.read") as s:
+            data = load_numpy_from_list(path_data, **crops)
+            s.add_bytes(data.nbytes)
+    elif data_format == "store":
+        data = load_store(
+            path_data,
+            slice_range=slice_range,
+            num_workers=num_workers,
+            dtype=loader_dtype,
+            keep_integer=keep_integer,
+            **crops,
+        )
     else:
-        raise ValueError("Unknown data format. Expected nifti, dicom or npy")
-    data = data.squeeze()
+        raise ValueError("Unknown data format. Expected nifti, dicom, npy, list or store")
+    if not lazy:  # LazyVolume is squeezed on opening
+        data = data.squeeze()
+        if dtype is not None and not keep_integer:
+            with instrumentation.stage("cast") as s:
+                data = data.astype(dtype, copy=False)
+                s.add_bytes(data.nbytes)
 
     if target_size is not None:  # Resize to target_size
-        data = preprocessor.resize_vol(data, target_size)
+        with instrumentation.stage("resize") as s:
+            data = preprocessor.resize_vol(data, target_size, dtype=dtype)
+            s.add_bytes(data.nbytes)
 
     if normalize:  # Normalize data
-        data = preprocessor.normalize_volume(data)
+        with instrumentation.stage("normalize") as s:
+            data = preprocessor.normalize_volume(data, dtype=dtype)
+            s.add_bytes(data.nbytes)
 
-    if central_50pc_crop:
-        data = data_utils.crop_central_50pc(data)
+    if lazy and (central_50pc_crop or target_fov is not None):  # Reads just the cropped range
+        with instrumentation.stage("crop"):
+            data = data[_crop_key(data.shape, central_50pc_crop, target_fov)]
+            if central_50pc_crop and data.ndim < 3:
+                data = data_utils.crop_central_50pc(data)
+    else:
+        if target_fov is not None and not crop_fov_on_load:
+            with instrumentation.stage("crop"):
+                data = data[_crop_key(data.shape, target_fov=target_fov)]  # `preprocessor.crop_fov` of every slice
+        if central_50pc_crop and (not crop_central_on_load or data.ndim < 3):
+            with instrumentation.stage("crop"):
+                data = data_utils.crop_central_50pc(data)
 
     # # Debug - visualize
     # print(f"Debug - visualize {path_data}")
@@ -174,6 +610,72 @@ def load_data(
     #
     # sass.scroll(data)
 
+    if use_cache:
+        with instrumentation.stage("cache.put") as s:
+            cache.put(cache_key, data)
+            s.add_bytes(data.nbytes)
+
     if return_dicoms:
         return data, dicoms
     return data
+
+
+def iter_volumes(
+        paths: Iterable[Path],
+        data_format: str,
+        normalize: bool,
+        prefetch: int = 2,
+        prefetch_workers: int = 1,
+        prefetch_executor: str = "thread",
+        **kwargs,
+) -> Iterator[Tuple[Path, Union[np.ndarray, Exception]]]:
+    """
+    Iterates over `load_data` of every path while the next `prefetch` volumes are loaded and preprocessed in the
+    background. At most `prefetch` volumes are held besides the one being consumed.
+
+    Parameters
+    ----------
+    paths : iterable
+        Paths passed as `path_data`, e.g. the result of `glob_nifti`.
+    data_format : str
+        See `load_data`.
+    normalize : bool
+        See `load_data`.
+    prefetch : int, default=2
+        Number of volumes loaded ahead of the consumer.
+    prefetch_workers : int, default=1
+        Number of volumes loaded concurrently.
+    prefetch_executor : str, default="thread"
+        Pool loading the volumes: "thread" or "process".
+    **kwargs
+        Remaining `load_data` arguments.
+
+    Yields
+    ------
+    path : Path
+    vol : np.ndarray or Exception
+        `load_data` result in the order of `paths`, or the exception raised loading this path. A failed path does not
+        stop the iteration.
+    """
+    if prefetch_executor not in ("thread", "process"):
+        raise ValueError(f"prefetch_executor must be thread or process, got {prefetch_executor}")
+    pool_class = ThreadPoolExecutor if prefetch_executor == "thread" else ProcessPoolExecutor
+
+    paths = iter(paths)
+    pool = pool_class(max_workers=prefetch_workers)
+    pending = deque()
+    try:
+        for path in islice(paths, max(prefetch, 1)):
+            pending.append((path, pool.submit(load_data, path, data_format, normalize, **kwargs)))
+
+        while pending:
+            path, future = pending.popleft()
+            try:
+                vol = future.result()
+            except Exception as e:
+                vol = e
+            for next_path in islice(paths, 1):  # Keep the queue full while the consumer works on `vol`
+                pending.append((next_path, pool.submit(load_data, next_path, data_format, normalize, **kwargs)))
+            yield path, vol
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)  # Consumer stopped early: drop loads not yet started
@@ -1,13 +1,28 @@
-from typing import Union, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Sequence, Union, Tuple
 
 import numpy as np
 
+from common_utils import instrumentation
 
-def crop_central_50pc(vol: np.ndarray) -> np.ndarray:
-    num_slices = vol.shape[-1]
+# Active memo of `memoize_masks`, maps id(vol) -> (vol, mask)
+_MASK_MEMO: ContextVar[Optional[dict]] = ContextVar("mask_memo", default=None)
+# Integer volumes spanning more values than this fall back to `np.percentile` in `slice_percentiles`
+_MAX_HISTOGRAM_BINS = 1 << 20
+
+
+def central_50pc_slice(num_slices: int) -> slice:
+    """
+    Range of the central 50% of `num_slices` slices kept by `crop_central_50pc`.
+    """
     to_crop = int(0.25 * num_slices)
     central_slice = num_slices // 2
-    vol_cropped = vol[..., central_slice - to_crop: central_slice + to_crop]
+    return slice(central_slice - to_crop, central_slice + to_crop)
+
+
+def crop_central_50pc(vol: np.ndarray) -> np.ndarray:
+    vol_cropped = vol[..., central_50pc_slice(vol.shape[-1])]
 
     return vol_cropped
 
@@ -35,47 +50,43 @@ def fill_subject(vol: np.ndarray, fill_value: float = 1.0) -> np.ndarray:
     return vol_filled
 
 
+def _noise_rows_for_AMRI_IP(mask: np.ndarray, buffer: int = 5) -> np.ndarray:
+    """
+    Boolean (rows, slices) array of the rows above the subject and below it, `buffer` rows away from the first and
+    last rows containing subject.
+    """
+    rows_with_subject = mask.any(axis=1)
+    n_rows = mask.shape[0]
+    first_row = np.argmax(rows_with_subject, axis=0) - buffer
+    last_row = n_rows - np.argmax(rows_with_subject[::-1], axis=0) + buffer  # Last row + 1 + buffer
+    rows = np.arange(n_rows)[:, np.newaxis]
+    return (rows < first_row) | (rows >= last_row)
+
+
 def extract_noise_for_AMRI_IP(vol_noisy: np.ndarray) -> np.ndarray:
+    """
+    Extracts the non-zero background samples above and below the subject in every slice.
+
+    Parameters
+    ==========
+    vol_noisy : np.ndarray
+        Input volume.
+
+    Returns
+    =======
+    noise : np.ndarray
+        1D array of noise samples, ordered slice by slice and then row-major within each slice.
+    """
     if vol_noisy.ndim != 3:
         vol_noisy = np.expand_dims(vol_noisy, axis=-1)
 
-    # Resulting vol has subject filled with 1e3 values
-    vol_filled_1e3 = fill_subject(vol_noisy, fill_value=1e3)
-
-    noise = []
-    for i in range(vol_filled_1e3.shape[-1]):  # Iterate over slices
-        s = vol_filled_1e3[..., i]  # Slice
-        idx_1e3 = np.argwhere(s == 1e3)  # Indices of all pixels == 1e3
-        idx_1e3 = np.hsplit(idx_1e3, 2)  # Split indices into indices of [rows, cols]
-        first_row = np.min(idx_1e3[0])  # First row that contains 1e3
-        last_row = np.max(idx_1e3[0]) + 1  # Last row + 1 that contains 1e3
-        first_row -= 5  # Buffer
-        last_row += 5  # Buffer
-
-        if first_row > 0:
-            noise_top = s[:first_row]
-            noise.extend(noise_top.flatten())
-
-        if 0 < last_row < vol_filled_1e3.shape[0]:
-            noise_bottom = s[last_row:]
-            noise.extend(noise_bottom.flatten())
-
-    # Debug - visualize noise crop
-    # if rows_crop_till > 0 or rows_crop_from > 0 and rows_crop_from < vol_filled_1e3.shape[0]:
-    #     print('Debug - visualize noise crop')
-    #     from matplotlib import pyplot as plt
-    #     plt.imshow(s, cmap='gray')
-    #     if rows_crop_till > 0:
-    #         plt.axhline(rows_crop_till)
-    #         print(f"rows_crop_till: {rows_crop_till}")
-    #     if rows_crop_from > 0 and rows_crop_from < vol_filled_1e3.shape[0]:
-    #         plt.axhline(rows_crop_from)
-    #         print(f"rows_crop_from: {rows_crop_from}")
-    #     plt.show()
+    noise_rows = _noise_rows_for_AMRI_IP(subject_mask(vol_noisy))
+
+    # Gathering from the slice-major view keeps samples ordered slice by slice, top rows before bottom rows
+    noise = np.moveaxis(vol_noisy, -1, 0)[noise_rows.T].ravel()
 
     # Remove zero values
-    nonzero = np.nonzero(noise)
-    noise = np.take(noise, nonzero).squeeze()
+    noise = noise[noise != 0]
 
     # # Debug - visualize noise block
     # from matplotlib import pyplot as plt
@@ -89,6 +100,144 @@ def extract_noise_for_AMRI_IP(vol_noisy: np.ndarray) -> np.ndarray:
     return noise
 
 
+def extract_noise_var_for_AMRI_IP(vol_noisy: np.ndarray) -> float:
+    """
+    Variance of the samples returned by `extract_noise_for_AMRI_IP`, accumulated slice by slice (Chan et al.'s
+    parallel update) without gathering all samples.
+    """
+    if vol_noisy.ndim != 3:
+        vol_noisy = np.expand_dims(vol_noisy, axis=-1)
+
+    count, mean, m2 = accumulate_noise_var_for_AMRI_IP(vol_noisy, 0, 0.0, 0.0)
+
+    if count == 0:
+        return float("nan")
+    return m2 / count
+
+
+def accumulate_noise_var_for_AMRI_IP(
+        vol_noisy: np.ndarray, count: int, mean: float, m2: float
+) -> Tuple[int, float, float]:
+    """
+    Merges the noise samples of every slice of `vol_noisy` into the running (count, mean, sum of squared deviations),
+    so the noise variance of a volume can be accumulated over slabs of slices. The variance is `m2 / count`.
+    """
+    noise_rows = _noise_rows_for_AMRI_IP(subject_mask(vol_noisy))
+
+    for i in range(vol_noisy.shape[-1]):  # Iterate over slices
+        noise = vol_noisy[noise_rows[:, i], :, i]
+        noise = noise[noise != 0]
+        if noise.size == 0:
+            continue
+
+        slice_mean = noise.mean(dtype=np.float64)
+        slice_m2 = np.square(noise - slice_mean).sum(dtype=np.float64)
+        delta = slice_mean - mean
+        total = count + noise.size
+        mean += delta * noise.size / total
+        m2 += slice_m2 + delta ** 2 * count * noise.size / total
+        count = total
+
+    return count, mean, m2
+
+
+@contextmanager
+def memoize_masks():
+    """
+    Within this context `subject_mask` computes the mask of each volume object only once, so `fill_subject`,
+    `mask_subject` and the metrics share a single mask computation. Volumes must not be modified in place inside the
+    context. Contexts can be nested; the outermost one owns the memo.
+    """
+    if _MASK_MEMO.get() is not None:
+        yield
+        return
+
+    token = _MASK_MEMO.set({})
+    try:
+        yield
+    finally:
+        _MASK_MEMO.reset(token)
+
+
+def slice_percentiles(vol: np.ndarray, q: Sequence[float]) -> np.ndarray:
+    """
+    Per-slice percentiles, `np.percentile(vol, q, axis=(0, 1))`. For integer volumes, e.g. DICOM loaded with
+    `keep_integer=True`, every slice is counted into a histogram with `np.bincount` and the percentiles are read off its
+    cumulative sum: O(n) per slice instead of partitioning a float copy, with identical results (linear interpolation
+    between the two closest ranks, as numpy).
+
+    Parameters
+    ==========
+    vol : np.ndarray
+        Input volume of shape (x, y, ...).
+    q : sequence of float
+        Percentiles in [0, 100].
+
+    Returns
+    =======
+    percentiles : np.ndarray
+        Array of shape (len(q),) + vol.shape[2:].
+    """
+    if not np.issubdtype(vol.dtype, np.integer) or vol.ndim < 2 or vol.size == 0:
+        return np.percentile(vol, q, axis=(0, 1))
+    vmin, vmax = int(vol.min()), int(vol.max())
+    if vmax - vmin >= _MAX_HISTOGRAM_BINS:
+        return np.percentile(vol, q, axis=(0, 1))
+
+    # Ranks interpolated between, as numpy's "linear" method
+    n = vol.shape[0] * vol.shape[1]
+    virtual = (n - 1) * (np.asarray(q, dtype=np.float64) / 100)
+    previous = np.floor(virtual).astype(np.intp)
+    following = np.minimum(previous + 1, n - 1)
+    gamma = virtual - previous
+
+    slices = vol.reshape(vol.shape[:2] + (-1,))
+    lower = np.empty((len(previous), slices.shape[-1]))
+    upper = np.empty((len(previous), slices.shape[-1]))
+    for i in range(slices.shape[-1]):
+        _slice = slices[..., i]
+        counts = np.bincount(np.subtract(_slice, vmin, dtype=np.intp).ravel() if vmin else _slice.ravel())
+        cumulative = np.cumsum(counts)
+        # Value of rank r is the first value whose cumulative count exceeds r
+        lower[:, i] = np.searchsorted(cumulative, previous, side="right") + vmin
+        upper[:, i] = np.searchsorted(cumulative, following, side="right") + vmin
+
+    gamma = gamma[:, np.newaxis]
+    diff = upper - lower
+    percentiles = np.where(gamma >= 0.5, upper - diff * (1 - gamma), lower + diff * gamma)  # numpy's `_lerp`
+    return percentiles.reshape((len(previous),) + vol.shape[2:])
+
+
+def subject_threshold(vol: np.ndarray) -> np.ndarray:
+    """
+    Per-slice threshold of [1], 10% of the way from the 2nd to the 98th percentile. Both percentiles are computed in
+    one pass by `slice_percentiles`, from a histogram for integer volumes.
+
+    [1] Jenkinson M. (2003). Fast, automated, N-dimensional phase-unwrapping algorithm. Magnetic resonance in medicine,
+    49(1), 193–197. https://doi.org/10.1002/mrm.10354
+    """
+    p2, p98 = slice_percentiles(vol, [2, 98])
+    return 0.1 * (p98 - p2) + p2
+
+
+def subject_mask(vol: np.ndarray) -> np.ndarray:
+    """
+    Boolean mask of the subject, `vol >= subject_threshold(vol)`. Memoised per volume inside `memoize_masks`.
+    """
+    memo = _MASK_MEMO.get()
+    if memo is not None:
+        entry = memo.get(id(vol))
+        if entry is not None and entry[0] is vol:
+            return entry[1]
+
+    with instrumentation.stage("data_utils.subject_mask"):
+        mask = vol >= subject_threshold(vol)
+
+    if memo is not None:
+        memo[id(vol)] = (vol, mask)  # Holding `vol` keeps its id from being reused within the context
+    return mask
+
+
 def mask_subject(
         vol: np.ndarray, return_indices: bool = False
 ) -> Union[Tuple[np.ndarray, np.ndarray], np.ndarray]:
@@ -112,12 +261,8 @@ def mask_subject(
     mask_indices : np.ndarray, optional
         Indices of the subject.
     """
-    vol_masked = np.zeros_like(vol)
-    threshold = 0.1 * (
-            np.percentile(vol, 98, axis=(0, 1)) - np.percentile(vol, 2, axis=(0, 1))
-    ) + np.percentile(vol, 2, axis=(0, 1))
-    mask_indices = vol >= threshold
-    vol_masked[mask_indices] = 1
+    mask_indices = subject_mask(vol)
+    vol_masked = mask_indices.astype(vol.dtype)
 
     if return_indices:
         return vol_masked, mask_indices
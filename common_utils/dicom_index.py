@@ -0,0 +1,184 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pydicom as pyd
+
+from common_utils.sort_DCM import natural_sort, sort_DCM_filenames
+
+# Only these tags are parsed from each header, pixel data is never read
+_HEADER_TAGS = [
+    "SeriesInstanceUID",
+    "InstanceNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "Rows",
+    "Columns",
+    "BitsAllocated",
+    "PixelRepresentation",
+]
+
+
+class DicomSlice(NamedTuple):
+    path: Path
+    series_uid: str
+    instance_number: Optional[int]
+    position: Optional[Tuple[float, float, float]]
+    orientation: Optional[Tuple[float, ...]]
+    rows: int
+    cols: int
+    dtype: Optional[np.dtype]
+
+
+class DicomIndex(NamedTuple):
+    series: Dict[str, List[DicomSlice]]  # SeriesInstanceUID -> slices sorted by geometry
+    folders: Dict[Path, List[str]]  # Absolute folder -> SeriesInstanceUIDs found in it
+    unreadable: Dict[Path, str]  # Files whose header could not be read -> error, left out of every series
+
+
+def is_dicom_filename(name: str) -> bool:
+    return ".MRDC." in name or name.endswith(".dcm") or name.endswith(".IMA")
+
+
+def walk_files(path_root: Path) -> Iterator[Path]:
+    """
+    Yields every file under `path_root` in a single `os.scandir` pass over the tree.
+    """
+    stack = [str(path_root)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield Path(entry.path)
+
+
+def _pixel_dtype(bits: int, signed: bool) -> Optional[np.dtype]:
+    # dtype of `Dataset.pixel_array`: 1 bit (e.g. segmentation masks) is unpacked to uint8, other sizes that are not
+    # whole bytes have no numpy dtype
+    if bits == 1:
+        return np.dtype(np.uint8)
+    if bits in (8, 16, 32, 64):
+        return np.dtype(f"{'i' if signed else 'u'}{bits // 8}")
+    return None
+
+
+def read_header(path_dicom: Path) -> DicomSlice:
+    dicom = pyd.dcmread(str(path_dicom), stop_before_pixels=True, specific_tags=_HEADER_TAGS)
+
+    instance_number = dicom.get("InstanceNumber")
+    position = dicom.get("ImagePositionPatient")
+    orientation = dicom.get("ImageOrientationPatient")
+    bits = dicom.get("BitsAllocated")
+    if bits is not None:
+        dtype = _pixel_dtype(int(bits), dicom.get("PixelRepresentation", 0) == 1)
+    else:
+        dtype = None
+
+    return DicomSlice(
+        path=path_dicom,
+        series_uid=str(dicom.get("SeriesInstanceUID", "")),
+        instance_number=int(instance_number) if instance_number is not None else None,
+        position=tuple(float(p) for p in position) if position is not None else None,
+        orientation=tuple(float(o) for o in orientation) if orientation is not None else None,
+        rows=int(dicom.get("Rows", 0)),
+        cols=int(dicom.get("Columns", 0)),
+        dtype=dtype,
+    )
+
+
+def _try_read_header(path_dicom: Path) -> Tuple[Optional[DicomSlice], Optional[str]]:
+    # (header, None), or (None, error) for a truncated or otherwise unreadable file
+    try:
+        header = read_header(path_dicom)
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    if not header.series_uid:  # Required in every DICOM, missing when the file is truncated before it
+        return None, "No SeriesInstanceUID"
+    return header, None
+
+
+def sort_slices(slices: List[DicomSlice]) -> List[DicomSlice]:
+    """
+    Sorts the slices of one series by their position along the slice normal. The direction follows InstanceNumber
+    when it is available. Falls back to InstanceNumber, and then to filename parsing (natural order if filenames hold
+    no slice numbers), when geometry is missing.
+    """
+    if all(s.position is not None and s.orientation is not None for s in slices):
+        normal = np.cross(slices[0].orientation[:3], slices[0].orientation[3:])
+        sorted_slices = sorted(
+            slices, key=lambda s: (float(np.dot(s.position, normal)), s.instance_number or 0)
+        )
+        first, last = sorted_slices[0].instance_number, sorted_slices[-1].instance_number
+        if first is not None and last is not None and first > last:
+            sorted_slices.reverse()
+        return sorted_slices
+    if all(s.instance_number is not None for s in slices):
+        return sorted(slices, key=lambda s: s.instance_number)
+
+    by_path = {s.path: s for s in slices}
+    try:
+        return [by_path[f] for f in sort_DCM_filenames(list(by_path))]
+    except (IndexError, ValueError):  # Filenames without the slice numbers sort_DCM_filenames parses
+        return [by_path[f] for f in natural_sort(list(by_path))]
+
+
+def index_dicom_tree(path_root: Path, num_workers: int = 0) -> DicomIndex:
+    """
+    Builds an index of every DICOM series under `path_root` in a single pass, reading only header tags.
+
+    Parameters
+    ==========
+    path_root : Path
+        Root of the directory tree to index.
+    num_workers : int, default=0
+        Number of threads used to read headers concurrently. 0 reads headers sequentially.
+
+    Returns
+    =======
+    dicom_index : DicomIndex
+        Sorted slices per SeriesInstanceUID, the series found in each folder, and the files that could not be read,
+        which are skipped instead of failing the whole index.
+    """
+    files = [f for f in walk_files(path_root) if is_dicom_filename(f.name)]
+    if num_workers > 0:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(_try_read_header, files))
+    else:
+        results = [_try_read_header(f) for f in files]
+
+    series = {}
+    folders = {}
+    unreadable = {}
+    for f, (h, error) in zip(files, results):
+        if h is None:
+            unreadable[f] = error
+            continue
+        series.setdefault(h.series_uid, []).append(h)
+        folder_uids = folders.setdefault(Path(os.path.abspath(h.path.parent)), [])
+        if h.series_uid not in folder_uids:
+            folder_uids.append(h.series_uid)
+    series = {uid: sort_slices(slices) for uid, slices in series.items()}
+
+    return DicomIndex(series=series, folders=folders, unreadable=unreadable)
+
+
+def get_series(dicom_index: DicomIndex, key: Union[str, Path]) -> List[DicomSlice]:
+    """
+    Looks up the sorted slices of a series by SeriesInstanceUID or by the folder containing it.
+    """
+    if isinstance(key, Path):
+        uids = dicom_index.folders.get(Path(os.path.abspath(key)), [])
+        if len(uids) == 0:
+            raise KeyError(f"No DICOM series indexed in {key}")
+        if len(uids) > 1:
+            raise ValueError(f"{key} contains {len(uids)} series. Look up by SeriesInstanceUID instead")
+        key = uids[0]
+    return dicom_index.series[key]
+
+
+def get_series_files(dicom_index: DicomIndex, key: Union[str, Path]) -> List[Path]:
+    return [s.path for s in get_series(dicom_index, key)]
@@ -0,0 +1,244 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+# Hooks of the active `instrument` contexts, and whether they track allocations
+_HOOKS: ContextVar[tuple] = ContextVar("instrumentation_hooks", default=())
+_TRACK_ALLOCATIONS: ContextVar[bool] = ContextVar("instrumentation_track_allocations", default=False)
+# Stages entered and not yet exited, innermost last, used to attribute allocation peaks to enclosing stages
+_STAGE_STACK: ContextVar[tuple] = ContextVar("instrumentation_stage_stack", default=())
+# Hooks called for every stage in every context, see `add_hook`
+_GLOBAL_HOOKS: List[Callable] = []
+
+
+class StageEvent(NamedTuple):
+    name: str
+    seconds: float
+    nbytes: Optional[int]  # Bytes read or produced by the stage, if reported
+    peak_bytes: Optional[int]  # Peak traced allocation above the start of the stage, if tracking allocations
+    metadata: dict
+
+
+class _NullStage:
+    # Returned by `stage` when nothing listens, every method is a no-op
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add_bytes(self, nbytes: int):
+        pass
+
+    def annotate(self, **metadata):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    enabled = True
+
+    def __init__(self, name: str, hooks: tuple, track_allocations: bool, metadata: dict):
+        self.name = name
+        self.metadata = metadata
+        self._hooks = hooks
+        self._track = track_allocations and tracemalloc.is_tracing()
+        self._nbytes = None
+        self._start = 0.0
+        self._start_memory = 0
+        self._peak_memory = 0
+        self._token = None
+
+    def add_bytes(self, nbytes: int):
+        self._nbytes = int(nbytes) if self._nbytes is None else self._nbytes + int(nbytes)
+
+    def annotate(self, **metadata):
+        self.metadata.update(metadata)
+
+    def _update_parent_peak(self, peak: int):
+        stack = _STAGE_STACK.get()
+        if stack:
+            stack[-1]._peak_memory = max(stack[-1]._peak_memory, peak)
+
+    def __enter__(self):
+        if self._track:
+            current, peak = tracemalloc.get_traced_memory()
+            self._update_parent_peak(peak)  # tracemalloc has a single peak, hand it to the parent before resetting
+            tracemalloc.reset_peak()
+            self._start_memory = current
+            self._peak_memory = current
+            self._token = _STAGE_STACK.set(_STAGE_STACK.get() + (self,))
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        peak_bytes = None
+        if self._track:
+            self._peak_memory = max(self._peak_memory, tracemalloc.get_traced_memory()[1])
+            _STAGE_STACK.reset(self._token)
+            self._update_parent_peak(self._peak_memory)
+            peak_bytes = self._peak_memory - self._start_memory
+
+        metadata = self.metadata
+        if exc_type is not None:
+            metadata = dict(metadata, error=f"{exc_type.__name__}: {exc}")
+        event = StageEvent(name=self.name, seconds=seconds, nbytes=self._nbytes, peak_bytes=peak_bytes,
+                           metadata=metadata)
+        for hook in self._hooks:
+            hook(event)
+        return False
+
+
+def enabled() -> bool:
+    """
+    Whether any hook is listening. Callers can skip computing expensive metadata when it is not.
+    """
+    return bool(_HOOKS.get()) or bool(_GLOBAL_HOOKS)
+
+
+def stage(name: str, **metadata):
+    """
+    Context manager timing a stage and reporting a `StageEvent` to every active hook on exit. Bytes and metadata known
+    only inside the stage are reported with `add_bytes` and `annotate` on the returned object. When no hook is active a
+    shared no-op object is returned, so instrumented code costs one context variable lookup.
+
+    Examples
+    ========
+    >>> with stage("nifti.read", path=str(path_nifti)) as s:
+    ...     vol = np.asanyarray(nii.dataobj)
+    ...     s.add_bytes(vol.nbytes)
+    """
+    hooks = _HOOKS.get()
+    if not hooks and not _GLOBAL_HOOKS:
+        return _NULL_STAGE
+    return _Stage(name, hooks + tuple(_GLOBAL_HOOKS), _TRACK_ALLOCATIONS.get(), metadata)
+
+
+def emit(name: str, seconds: float, nbytes: Optional[int] = None, **metadata):
+    """
+    Reports a stage that was timed elsewhere, e.g. in a worker process, to every active hook.
+    """
+    hooks = _HOOKS.get() + tuple(_GLOBAL_HOOKS)
+    if not hooks:
+        return
+    event = StageEvent(name=name, seconds=seconds, nbytes=nbytes, peak_bytes=None, metadata=metadata)
+    for hook in hooks:
+        hook(event)
+
+
+def bind_context(func: Callable) -> Callable:
+    """
+    Wraps `func` so that stages it runs in pool worker threads report to the hooks active where it was wrapped.
+    Returns `func` itself when no hook is active.
+    """
+    hooks = _HOOKS.get()
+    if not hooks:
+        return func
+    track_allocations = _TRACK_ALLOCATIONS.get()
+
+    def _run(*args, **kwargs):
+        hooks_token = _HOOKS.set(hooks)
+        track_token = _TRACK_ALLOCATIONS.set(track_allocations)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _TRACK_ALLOCATIONS.reset(track_token)
+            _HOOKS.reset(hooks_token)
+
+    return _run
+
+
+def add_hook(hook: Callable[[StageEvent], None]):
+    """
+    Registers `hook` for every stage in every thread and context, e.g. to log timings in production.
+    """
+    _GLOBAL_HOOKS.append(hook)
+
+
+def remove_hook(hook: Callable[[StageEvent], None]):
+    _GLOBAL_HOOKS.remove(hook)
+
+
+class StageRecorder:
+    """
+    Hook collecting every `StageEvent`, with per-stage totals.
+    """
+
+    def __init__(self):
+        self.events = []  # type: List[StageEvent]
+
+    def __call__(self, event: StageEvent):
+        self.events.append(event)
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Per stage name: number of calls, total seconds, total bytes and the largest allocation peak.
+        """
+        summary = {}
+        for event in self.events:
+            s = summary.setdefault(event.name, {"count": 0, "seconds": 0.0, "nbytes": None, "peak_bytes": None})
+            s["count"] += 1
+            s["seconds"] += event.seconds
+            if event.nbytes is not None:
+                s["nbytes"] = event.nbytes + (s["nbytes"] or 0)
+            if event.peak_bytes is not None:
+                s["peak_bytes"] = max(event.peak_bytes, s["peak_bytes"] or 0)
+        return summary
+
+    def report(self):
+        """
+        Prints the summary, slowest stage first.
+        """
+        print(f"{'stage':40s} {'calls':>6s} {'seconds':>10s} {'MB':>10s} {'peak MB':>10s}")
+        for name, s in sorted(self.summary().items(), key=lambda item: -item[1]["seconds"]):
+            mb = f"{s['nbytes'] / 2 ** 20:10.1f}" if s["nbytes"] is not None else f"{'-':>10s}"
+            peak_mb = f"{s['peak_bytes'] / 2 ** 20:10.1f}" if s["peak_bytes"] is not None else f"{'-':>10s}"
+            print(f"{name:40s} {s['count']:6d} {s['seconds']:10.4f} {mb} {peak_mb}")
+
+
+@contextmanager
+def instrument(hook: Optional[Callable[[StageEvent], None]] = None, track_allocations: bool = False):
+    """
+    Records every stage run inside this context, e.g. by `data_loader.load_data`, the metrics and the converters.
+
+    Parameters
+    ==========
+    hook : callable, optional
+        Called with every `StageEvent` as it happens, in addition to the returned recorder.
+    track_allocations : bool, default=False
+        Whether to record the peak of traced allocations (numpy arrays included) of every stage with `tracemalloc`.
+        Slows down allocation-heavy code. Peaks are only meaningful for stages that do not overlap other threads.
+
+    Yields
+    ======
+    recorder : StageRecorder
+        Every event recorded in this context.
+
+    Examples
+    ========
+    >>> with instrument(track_allocations=True) as recorder:
+    ...     vol = data_loader.load_data(path, "nifti", normalize=True, target_size=256)
+    >>> recorder.report()
+    """
+    recorder = StageRecorder()
+    hooks = _HOOKS.get() + ((hook,) if hook is not None else ()) + (recorder,)
+
+    started_tracing = track_allocations and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    hooks_token = _HOOKS.set(hooks)
+    track_token = _TRACK_ALLOCATIONS.set(track_allocations or _TRACK_ALLOCATIONS.get())
+    try:
+        yield recorder
+    finally:
+        _TRACK_ALLOCATIONS.reset(track_token)
+        _HOOKS.reset(hooks_token)
+        if started_tracing:
+            tracemalloc.stop()
@@ -0,0 +1,92 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+def rescale_params(dicom) -> Tuple[float, float]:
+    """
+    (RescaleSlope, RescaleIntercept) of a `pydicom.Dataset`, (1, 0) when absent.
+    """
+    slope = dicom.get("RescaleSlope", None)
+    intercept = dicom.get("RescaleIntercept", None)
+    return float(slope) if slope is not None else 1.0, float(intercept) if intercept is not None else 0.0
+
+
+class IntegerVolume(np.ndarray):
+    """
+    Volume of stored integer pixel values, e.g. uint16/int16 DICOM pixel data, 4x smaller than float64. The modality
+    rescale (RescaleSlope/RescaleIntercept) is kept as metadata instead of being applied, so casting to float gives the
+    same values as loading the series as float and `rescaled` gives modality values.
+
+    Views, crops and integer casts keep the metadata. Casts to other dtypes and arithmetic return plain arrays, whose
+    values are no longer stored values.
+
+    Parameters
+    ----------
+    vol : np.ndarray
+        Integer array of stored values.
+    slope : float, default=1.0
+        RescaleSlope.
+    intercept : float, default=0.0
+        RescaleIntercept.
+    """
+
+    def __new__(cls, vol: np.ndarray, slope: float = 1.0, intercept: float = 0.0):
+        vol = np.asarray(vol)
+        if not np.issubdtype(vol.dtype, np.integer):
+            raise ValueError(f"IntegerVolume requires integer pixel data, got {vol.dtype}")
+        obj = vol.view(cls)
+        obj.slope = float(slope)
+        obj.intercept = float(intercept)
+        return obj
+
+    @classmethod
+    def from_slices(cls, vol: np.ndarray, params: Sequence[Tuple[float, float]]) -> "IntegerVolume":
+        """
+        Wraps `vol` with the (slope, intercept) of every slice, which must all be equal.
+        """
+        params = set(params)
+        if len(params) > 1:
+            raise ValueError(
+                f"Slices have {len(params)} different RescaleSlope/RescaleIntercept, load them as float instead"
+            )
+        slope, intercept = params.pop() if params else (1.0, 0.0)
+        return cls(vol, slope=slope, intercept=intercept)
+
+    def __array_finalize__(self, obj):
+        self.slope = getattr(obj, "slope", 1.0)
+        self.intercept = getattr(obj, "intercept", 0.0)
+
+    def __array_wrap__(self, array, context=None, return_scalar=False):
+        # Results of ufuncs are plain arrays (or scalars for reductions)
+        array = array.view(np.ndarray)
+        if return_scalar:
+            return array[()]
+        return array
+
+    def astype(self, dtype, *args, **kwargs) -> np.ndarray:
+        # `ndarray.astype` keeps the subclass, which must hold integers
+        vol = super().astype(dtype, *args, **kwargs)
+        if not np.issubdtype(vol.dtype, np.integer):
+            return vol.view(np.ndarray)
+        return vol
+
+    def __reduce__(self):
+        # Keeps the metadata through pickling, e.g. to and from worker processes
+        reconstruct, args, state = super().__reduce__()
+        return reconstruct, args, (state, self.slope, self.intercept)
+
+    def __setstate__(self, state):
+        state, self.slope, self.intercept = state
+        super().__setstate__(state)
+
+    def rescaled(self, dtype: np.dtype = np.float64) -> np.ndarray:
+        """
+        Modality values, `slope * vol + intercept`, as a plain float array.
+        """
+        vol = self.view(np.ndarray).astype(dtype)
+        if self.slope != 1:
+            vol *= vol.dtype.type(self.slope)
+        if self.intercept != 0:
+            vol += vol.dtype.type(self.intercept)
+        return vol
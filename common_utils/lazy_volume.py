@@ -0,0 +1,148 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from common_utils import preprocessor
+
+
+def _expand_key(key, ndim: int) -> tuple:
+    # Expands `key` to one index per axis, replacing Ellipsis
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError("np.newaxis is not supported")
+    n_ellipsis = sum(k is Ellipsis for k in key)
+    if n_ellipsis > 1:
+        raise IndexError("An index can only have a single ellipsis ('...')")
+    if n_ellipsis == 1:
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    if len(key) > ndim:
+        raise IndexError(f"Too many indices for volume: volume is {ndim}-dimensional, but {len(key)} were indexed")
+    return key + (slice(None),) * (ndim - len(key))
+
+
+def _as_slice(idx: np.ndarray):
+    # Evenly spaced indices become a slice so that indexing stays a view
+    if len(idx) == 0:
+        return idx
+    step = int(idx[1] - idx[0]) if len(idx) > 1 else 1
+    if step == 0 or np.any(np.diff(idx) != step):
+        return idx
+    stop = int(idx[-1]) + step
+    return slice(int(idx[0]), stop if stop >= 0 else None, step)
+
+
+class LazyVolume:
+    """
+    Read-only oriented view of an on-disk volume such as a nibabel `ArrayProxy`. The orientation is kept as a single
+    composed index transform (axis permutation + flips, see `orientation.compile_orientation`) and padding is virtual.
+    Data is only read, oriented and cast when slices are requested, so indexing a few slices touches only their bytes.
+
+    Parameters
+    ----------
+    dataobj : array-like
+        Source array supporting basic slicing, e.g. `nii.dataobj` or `np.memmap`.
+    perm : tuple
+        Source axis of every output axis.
+    flips : tuple
+        Whether every output axis is reversed.
+    pad : tuple, optional
+        `np.pad` style widths applied after orientation.
+    resize : int, optional
+        In-plane size every requested slice is resized to with `preprocessor.resize_vol`.
+    dtype : np.dtype, default=np.float64
+        dtype of the returned arrays.
+    """
+
+    def __init__(
+            self,
+            dataobj,
+            perm: tuple,
+            flips: tuple,
+            pad: Optional[tuple] = None,
+            resize: Optional[int] = None,
+            dtype=np.float64,
+    ):
+        self._dataobj = dataobj
+        self.perm = tuple(perm)
+        self.flips = tuple(flips)
+        self._oriented_shape = tuple(dataobj.shape[p] for p in self.perm)
+        self.pad = tuple(pad) if pad is not None else ((0, 0),) * len(self.perm)
+        self._padded_shape = tuple(n + before + after for n, (before, after) in zip(self._oriented_shape, self.pad))
+        self.resize = resize
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if self.resize is not None:
+            return (self.resize, self.resize) + self._padded_shape[2:]
+        return self._padded_shape
+
+    @property
+    def ndim(self) -> int:
+        return len(self.perm)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        vol = self[...]
+        return vol if dtype is None else vol.astype(dtype, copy=False)
+
+    def squeeze(self) -> np.ndarray:
+        return np.asarray(self).squeeze()
+
+    def _read(self, key, dtype=None) -> np.ndarray:
+        # Reads `key` of the oriented, padded (not resized) volume. dtype=None keeps the dtype of the source data
+        out_idx = []
+        squeeze_axes = []
+        for j, k in enumerate(_expand_key(key, self.ndim)):
+            idx = np.arange(self._padded_shape[j])[k]
+            if np.ndim(idx) == 0:
+                squeeze_axes.append(j)
+            out_idx.append(np.atleast_1d(idx))
+        out_shape = [len(idx) for idx in out_idx]
+
+        src_key = [slice(None)] * self.ndim
+        out_key = []
+        block_key = []
+        for j, idx in enumerate(out_idx):
+            p = idx - self.pad[j][0]  # Undo virtual padding
+            valid = (p >= 0) & (p < self._oriented_shape[j])
+            p = p[valid]
+            if len(p) == 0:  # Only padding requested
+                out = np.zeros(out_shape, dtype=self._dataobj.dtype if dtype is None else dtype)
+                return np.squeeze(out, axis=tuple(squeeze_axes))
+            if self.flips[j]:
+                p = self._oriented_shape[j] - 1 - p
+            lo = int(p.min())
+            src_key[self.perm[j]] = slice(lo, int(p.max()) + 1)  # Smallest contiguous source range
+            block_key.append(_as_slice(p - lo))
+            out_key.append(_as_slice(np.nonzero(valid)[0]))
+
+        block = np.asarray(self._dataobj[tuple(src_key)])
+        block = np.transpose(block, self.perm)
+        if all(isinstance(k, slice) for k in block_key):
+            block = block[tuple(block_key)]
+        else:
+            block = block[np.ix_(*[np.arange(n)[k] for n, k in zip(block.shape, block_key)])]
+        out = np.zeros(out_shape, dtype=block.dtype if dtype is None else dtype)
+        if all(isinstance(k, slice) for k in out_key):
+            out[tuple(out_key)] = block
+        else:
+            out[np.ix_(*[np.arange(n)[k] for n, k in zip(out.shape, out_key)])] = block
+
+        return np.squeeze(out, axis=tuple(squeeze_axes))
+
+    def __getitem__(self, key) -> np.ndarray:
+        if self.resize is None:
+            return self._read(key, dtype=self.dtype)
+
+        # Resize is in-plane: read full planes of the requested slices, resize, then index in-plane
+        key = _expand_key(key, self.ndim)
+        slice_key = tuple(k if not np.isscalar(k) else slice(k, k + 1 if k != -1 else None) for k in key[2:])
+        planes = self._read((slice(None), slice(None)) + slice_key)
+        planes = preprocessor.resize_vol(planes, self.resize)  # On the source dtype, as `load_nifti` does
+        squeeze_key = tuple(0 if np.isscalar(k) else slice(None) for k in key[2:])
+        return planes[(key[0], key[1]) + squeeze_key].astype(self.dtype)
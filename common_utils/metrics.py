@@ -1,15 +1,55 @@
-from typing import Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Iterable, List, Optional, Union
 
 import numpy as np
-from scipy.ndimage import convolve
-from scipy.ndimage import laplace
+from scipy.ndimage import correlate1d
+from scipy.ndimage import uniform_filter
 from skimage.draw import disk
 
 from common_utils import data_utils
+from common_utils import instrumentation
+from common_utils import preprocessor
+
+
+def laplace_2d(vol: np.ndarray) -> np.ndarray:
+    """
+    In-plane Laplacian of every slice of a (x, y, slices) volume at once, with the same stencil and "reflect"
+    boundaries as `scipy.ndimage.laplace` applied slice by slice. Computed with slicing arithmetic into one buffer so
+    that every pass is over contiguous memory.
+    """
+    if min(vol.shape[:2]) < 2:
+        lap = correlate1d(vol, [1, -2, 1], axis=0, mode="reflect")
+        lap += correlate1d(vol, [1, -2, 1], axis=1, mode="reflect")
+        return lap
+
+    lap = np.empty_like(vol)
+    # Second difference along rows, reflected boundary rows repeat the edge row
+    np.subtract(vol[:-2], vol[1:-1], out=lap[1:-1])
+    lap[1:-1] += vol[2:]
+    lap[1:-1] -= vol[1:-1]
+    np.subtract(vol[1], vol[0], out=lap[0])
+    np.subtract(vol[-2], vol[-1], out=lap[-1])
+
+    # Second difference along columns
+    lap[:, 1:-1] += vol[:, :-2]
+    lap[:, 1:-1] += vol[:, 2:]
+    lap[:, 1:-1] -= vol[:, 1:-1]
+    lap[:, 1:-1] -= vol[:, 1:-1]
+    lap[:, 0] += vol[:, 1]
+    lap[:, 0] -= vol[:, 0]
+    lap[:, -1] += vol[:, -2]
+    lap[:, -1] -= vol[:, -1]
+
+    return lap
 
 
 def get_laplacian_var(
-    vol: np.ndarray, mask_brain: bool = True, return_arr: bool = False
+    vol: np.ndarray,
+    mask_brain: bool = True,
+    return_arr: bool = False,
+    dtype: Optional[np.dtype] = None,
+    mask: Optional[np.ndarray] = None,
 ) -> Union[float, np.ndarray]:
     """
     Computes the median of the variance of the Laplacian of the input volume. The entire array can be returned by
@@ -22,50 +62,119 @@ def get_laplacian_var(
     mask_brain: bool, default=True
         Whether to mask the input volume with the brain mask.
     return_arr: bool, default=False
-        Whether to return the Laplacian array.
+        Whether to return the per-slice variances instead of their median.
+    dtype: np.dtype, optional
+        dtype the Laplacian is computed in. Defaults to the dtype of `vol` if floating, else float64.
+    mask: np.ndarray, optional
+        Precomputed boolean brain mask, e.g. from `data_utils.subject_mask`. Used instead of recomputing it when
+        `mask_brain=True`.
     """
+    vol = preprocessor.as_float(vol, dtype)
+    if vol.ndim == 2:
+        vol = np.expand_dims(vol, axis=-1)
     if mask_brain:
-        vol = data_utils.mask_subject(vol)
+        vol = mask.astype(vol.dtype) if mask is not None else data_utils.mask_subject(vol)
 
-    laplace_var_values = []
-    for i in range(vol.shape[-1]):
-        img = vol[..., i]
-        laplace_var_values.append(laplace(img).var())
+    with instrumentation.stage("metrics.laplacian_var") as s:
+        laplace_var_values = laplace_2d(vol).var(axis=(0, 1))
+        s.add_bytes(vol.nbytes)
 
     if return_arr:
         return laplace_var_values
     return float(np.median(laplace_var_values))
 
 
+def get_laplacian_var_batch(
+    vols: Iterable[np.ndarray],
+    mask_brain: bool = True,
+    return_arr: bool = False,
+    dtype: Optional[np.dtype] = None,
+    num_workers: int = 4,
+    executor: str = "thread",
+) -> List[Union[float, np.ndarray]]:
+    """
+    `get_laplacian_var` of many volumes in a thread or process pool. Results are in the order of `vols`.
+    """
+    if executor not in ("thread", "process"):
+        raise ValueError(f"Unknown executor {executor}. Expected thread or process")
+
+    pool_class = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor
+    fn = partial(get_laplacian_var, mask_brain=mask_brain, return_arr=return_arr, dtype=dtype)
+    if executor == "thread":
+        fn = instrumentation.bind_context(fn)  # Stages of worker processes are not reported
+    with pool_class(max_workers=num_workers) as pool:
+        return list(pool.map(fn, vols))
+
+
+def get_local_SNR_map(
+    vol: np.ndarray,
+    noise_var: float,
+    window: int = 3,
+    mask: Optional[np.ndarray] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Local SNR map in dB, 20 * log10(sqrt(max(mean(vol ** 2) / noise_var - 2, 1))), where the mean is taken over a
+    window ** 3 box with zero padding. The box mean is a separable `uniform_filter`, so every voxel costs O(1)
+    regardless of `window`. All arithmetic runs in place in a single output buffer.
+
+    Parameters
+    ==========
+    vol: np.ndarray
+        Input volume.
+    noise_var: float
+        Variance of the background noise.
+    window: int, default=3
+        Size of the box along every axis.
+    mask: np.ndarray, optional
+        Boolean mask broadcastable to `vol`. Values outside it are zeroed.
+    out: np.ndarray, optional
+        Output buffer of the same shape as `vol`. Can be `vol` itself to compute in place.
+    """
+    if out is None:
+        out = np.empty_like(vol)
+    dtype = out.dtype.type
+
+    np.square(vol, out=out)
+    # Even windows are centred like `scipy.ndimage.convolve` with an all-ones kernel
+    uniform_filter(out, size=window, output=out, mode="constant", origin=0 if window % 2 else -1)
+    out /= dtype(noise_var)
+    out -= 2
+    np.maximum(out, 0, out=out)
+    np.sqrt(out, out=out)
+
+    # Replace values <1 to avoid divide by 0 in log10
+    np.maximum(out, 1, out=out)
+    np.log10(out, out=out)
+    out *= dtype(20)  # dB
+
+    if mask is not None:
+        # Zero out values outside the mask
+        out *= mask
+
+    return out
+
+
 def get_local_SNR_map_for_AMRI_IP(
-    vol: np.ndarray, window: int = 3, mask_brain: bool = True
+    vol: np.ndarray,
+    window: int = 3,
+    mask_brain: bool = True,
+    dtype: Optional[np.dtype] = None,
 ) -> np.ndarray:
+    vol = preprocessor.as_float(vol, dtype)
     if vol.ndim != 3:
         vol = np.expand_dims(vol, axis=-1)
 
-    # Compute variance of noise
-    noise = data_utils.extract_noise_for_AMRI_IP(vol)
-    noise_var = np.var(noise)
-
-    # Compute local SNR
-    vol_squared = np.square(vol)
-    kernel = 1 / (window**3) * np.ones((window, window, window))
-    snr_map = convolve(vol_squared, kernel, mode="constant")
-    snr_map /= noise_var
-    snr_map -= 2
-    snr_map[snr_map < 0] = 0
-    snr_map = np.sqrt(snr_map)
+    with data_utils.memoize_masks():  # Noise extraction and brain masking share one mask
+        # Compute variance of noise
+        with instrumentation.stage("metrics.noise_var"):
+            noise_var = data_utils.extract_noise_var_for_AMRI_IP(vol)
 
-    # Replace values <1 to avoid divide by 0 in log10
-    snr_map[snr_map < 1] = 1
-    snr_map = 20 * np.log10(snr_map)  # dB
-
-    if mask_brain:
-        # Mask local SNR map and zero out values outside the brain
-        _, mask_indices = data_utils.mask_subject(vol, return_indices=True)
-        snr_map_masked = np.zeros_like(snr_map)
-        snr_map_masked[mask_indices] = snr_map[mask_indices]
-        snr_map = snr_map_masked
+        # Compute local SNR, zeroing out values outside the brain
+        mask = data_utils.subject_mask(vol) if mask_brain else None
+        with instrumentation.stage("metrics.local_SNR") as s:
+            snr_map = get_local_SNR_map(vol, noise_var, window=window, mask=mask)
+            s.add_bytes(snr_map.nbytes)
 
     # # Debug - report and visualize
     # print(
@@ -79,8 +188,12 @@ def get_local_SNR_map_for_AMRI_IP(
 
 
 def get_local_SNR_map_lowfield_phantom(
-    vol: np.ndarray, mask_radius: int = 70, window: int = 3
+    vol: np.ndarray,
+    mask_radius: int = 70,
+    window: int = 3,
+    dtype: Optional[np.dtype] = None,
 ) -> np.ndarray:
+    vol = preprocessor.as_float(vol, dtype)
     if vol.ndim != 3:
         vol = np.expand_dims(vol, axis=-1)
 
@@ -99,20 +212,13 @@ def get_local_SNR_map_lowfield_phantom(
     # plt.show()
 
     # Compute variance of noise
-    noise_crop = vol[~mask]
-    noise_var = np.var(noise_crop)
+    with instrumentation.stage("metrics.noise_var"):
+        noise_crop = vol[~mask]
+        noise_var = np.var(noise_crop)
 
     # Compute local SNR
-    vol_squared = np.square(vol)
-    kernel = 1 / (window**3) * np.ones((window, window, window))
-    snr_map = convolve(vol_squared, kernel, mode="constant")
-    snr_map /= noise_var
-    snr_map -= 2
-    snr_map[snr_map < 0] = 0
-    snr_map = np.sqrt(snr_map)
-
-    # Replace values <1 to avoid divide by 0 in log10
-    snr_map[snr_map < 1] = 1
-    snr_map = 20 * np.log10(snr_map)  # dB
+    with instrumentation.stage("metrics.local_SNR") as s:
+        snr_map = get_local_SNR_map(vol, noise_var, window=window)
+        s.add_bytes(snr_map.nbytes)
 
     return snr_map
@@ -0,0 +1,89 @@
+import json
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+INDEX_FILENAME = "index.json"
+
+
+def _data_offset(path_npy: Path) -> int:
+    # Byte offset of the array data inside an .npy file
+    with open(path_npy, "rb") as f:
+        major, _ = np.lib.format.read_magic(f)
+        if major == 1:
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        return f.tell()
+
+
+def save_volume(vol: np.ndarray, path_save_npy: Path):
+    """
+    Saves a (x, y, slices) volume as a single .npy in Fortran order, so that every slice, and every range of
+    consecutive slices, is one contiguous block on disk that `np.load(..., mmap_mode="r")` reads with one seek.
+    """
+    np.save(str(path_save_npy), np.asfortranarray(vol))
+
+
+def save_shards(vol: np.ndarray, path_save_dir: Path, shard_size: int = 64) -> dict:
+    """
+    Saves a (x, y, slices) volume as fixed-size shards of `shard_size` slices plus an `index.json` of slice ranges and
+    byte offsets. Shards are Fortran ordered, so slice ranges within a shard are contiguous.
+
+    Returns
+    =======
+    index : dict
+        Contents of `index.json`.
+    """
+    path_save_dir.mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    for start in range(0, vol.shape[-1], shard_size):
+        stop = min(start + shard_size, vol.shape[-1])
+        filename = f"shard_{start // shard_size:05d}.npy"
+        save_volume(vol[..., start:stop], path_save_dir / filename)
+        shards.append(
+            {"file": filename, "start": start, "stop": stop, "offset": _data_offset(path_save_dir / filename)}
+        )
+
+    index = {
+        "shape": list(vol.shape),
+        "dtype": np.dtype(vol.dtype).str,
+        "order": "F",
+        "shard_size": shard_size,
+        "shards": shards,
+    }
+    with open(path_save_dir / INDEX_FILENAME, "w") as f:
+        json.dump(index, f, indent=1)
+
+    return index
+
+
+def is_sharded(path_dir: Path) -> bool:
+    return (path_dir / INDEX_FILENAME).is_file()
+
+
+def read_index(path_dir: Path) -> dict:
+    with open(path_dir / INDEX_FILENAME) as f:
+        return json.load(f)
+
+
+def load_shards(path_dir: Path, start: Optional[int] = None, stop: Optional[int] = None) -> np.ndarray:
+    """
+    Loads slices [start, stop) of a sharded volume, touching only the shards that overlap the range.
+    """
+    index = read_index(path_dir)
+    n_slices = index["shape"][-1]
+    start, stop, _ = slice(start, stop).indices(n_slices)
+    stop = max(start, stop)
+
+    vol = np.empty(tuple(index["shape"][:-1]) + (stop - start,), dtype=np.dtype(index["dtype"]))
+    for shard in index["shards"]:
+        lo, hi = max(start, shard["start"]), min(stop, shard["stop"])
+        if lo >= hi:
+            continue
+        shard_vol = np.load(str(path_dir / shard["file"]), mmap_mode="r")
+        vol[..., lo - start: hi - start] = shard_vol[..., lo - shard["start"]: hi - shard["start"]]
+
+    return vol
@@ -0,0 +1,179 @@
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class OrientationSpec(NamedTuple):
+    ops: tuple = ()  # numpy operations applied in order, e.g. ("rot90", 1, (0, 1)), ("fliplr",)
+    pad: Optional[tuple] = None  # np.pad widths applied after `ops`
+    resize: Optional[int] = None  # In-plane size applied last with `preprocessor.resize_vol`
+
+
+# Dataset-contrast specific orientation of NIFTI volumes, see `data_loader.load_nifti`
+_FLIRT_PAD = ((37, 37), (19, 19), (0, 0))
+NIFTI_ORIENTATIONS = {
+    "HCP-T2": OrientationSpec(ops=(("moveaxis", 2, 1),)),
+    "HCP-T1": OrientationSpec(ops=(("rot90", -1, (0, 1)), ("fliplr",))),
+    "IXI-T1": OrientationSpec(ops=(("rot90", 1, (0, 1)),)),
+    "IXI_3T-T1": OrientationSpec(ops=(("rot90", 1, (0, 1)),)),
+    "IXI_15T-T1": OrientationSpec(ops=(("rot90", 1, (0, 1)),)),
+    "HCP-T1-BET": OrientationSpec(ops=(("rot90", -1, (0, 1)), ("fliplr",))),
+    "IXI-T1-BET": OrientationSpec(ops=(("rot90", 1, (0, 1)),)),
+    "HCP-T1-FLIRT": OrientationSpec(
+        ops=(("moveaxis", (0, 1, 2), (2, 1, 0)), ("fliplr",), ("flipud",)), pad=_FLIRT_PAD
+    ),
+    "IXI-T1-FLIRT": OrientationSpec(
+        ops=(("moveaxis", (0, 1, 2), (2, 1, 0)), ("fliplr",), ("flipud",)), pad=_FLIRT_PAD
+    ),
+    "HCP-T1-FLIRT-BET": OrientationSpec(
+        ops=(("moveaxis", 0, 2), ("rot90", 1, (0, 1)), ("fliplr",)), pad=_FLIRT_PAD
+    ),
+    "IXI-T1-FLIRT-BET": OrientationSpec(
+        ops=(("moveaxis", 0, 2), ("rot90", 1, (0, 1)), ("fliplr",)), pad=_FLIRT_PAD
+    ),
+    "MS_SEG-FLAIR": OrientationSpec(ops=(("rot90", 1, (0, 1)),), resize=256),
+    "ADNI_GO2-T1-FLIRT-BET": OrientationSpec(
+        ops=(("moveaxis", 0, 2), ("rot90", 1, (0, 1)), ("fliplr",)), pad=_FLIRT_PAD
+    ),
+    "ADNI-T2star": OrientationSpec(ops=(("rot90", 1, (0, 1)),)),
+}
+
+
+_COMPILED = {}  # (nifti_dataset, ndim) -> (perm, flips), filled by `get_orientation`
+
+
+def register_nifti_dataset(
+        nifti_dataset: str,
+        ops: tuple = (),
+        pad: Optional[tuple] = None,
+        resize: Optional[int] = None,
+        overwrite: bool = False,
+):
+    """
+    Registers the orientation of a new dataset-contrast, used by `data_loader.load_nifti(nifti_dataset=...)`.
+
+    Parameters
+    ==========
+    nifti_dataset : str
+        Dataset-contrast name.
+    ops : tuple
+        numpy operations applied in order, e.g. (("rot90", 1, (0, 1)), ("fliplr",)). See `compile_orientation`.
+    pad : tuple, optional
+        np.pad widths applied after `ops`.
+    resize : int, optional
+        In-plane size applied last with `preprocessor.resize_vol`.
+    overwrite : bool, default=False
+        Whether to replace an already registered dataset-contrast.
+    """
+    if nifti_dataset in NIFTI_ORIENTATIONS and not overwrite:
+        raise ValueError(f"{nifti_dataset} is already registered, pass overwrite=True to replace it")
+    ops = tuple(tuple(op) for op in ops)
+    compile_orientation(ops)  # Fail on unknown operations now rather than on load
+    NIFTI_ORIENTATIONS[nifti_dataset] = OrientationSpec(ops=ops, pad=pad, resize=resize)
+    for key in [key for key in _COMPILED if key[0] == nifti_dataset]:
+        del _COMPILED[key]
+
+
+def get_orientation(nifti_dataset: str, ndim: int = 3) -> Tuple[OrientationSpec, tuple, tuple]:
+    """
+    Spec of `nifti_dataset` and its (perm, flips), compiled once per dataset-contrast and number of dimensions.
+    Unregistered names get the identity orientation.
+    """
+    spec = NIFTI_ORIENTATIONS.get(nifti_dataset, OrientationSpec())
+    key = (nifti_dataset, ndim)
+    if key not in _COMPILED:
+        _COMPILED[key] = compile_orientation(spec.ops, ndim=ndim)
+    perm, flips = _COMPILED[key]
+    return spec, perm, flips
+
+
+def _moveaxis_order(source, destination, ndim: int) -> list:
+    # Same axis order as np.moveaxis
+    source = [s % ndim for s in np.atleast_1d(source)]
+    destination = [d % ndim for d in np.atleast_1d(destination)]
+    order = [n for n in range(ndim) if n not in source]
+    for dest, src in sorted(zip(destination, source)):
+        order.insert(dest, src)
+    return order
+
+
+def compile_orientation(ops: Sequence[tuple], ndim: int = 3) -> Tuple[tuple, tuple]:
+    """
+    Composes a chain of moveaxis/rot90/fliplr/flipud/transpose/flip operations into a single index transform.
+
+    Returns
+    =======
+    perm : tuple
+        Source axis of every output axis, as passed to `np.transpose`.
+    flips : tuple
+        Whether every output axis is reversed after the transpose.
+    """
+    perm = list(range(ndim))
+    flips = [False] * ndim
+
+    def _transpose(order):
+        perm[:] = [perm[o] for o in order]
+        flips[:] = [flips[o] for o in order]
+
+    def _flip(axis):
+        flips[axis] = not flips[axis]
+
+    for name, *args in ops:
+        if name == "moveaxis":
+            _transpose(_moveaxis_order(args[0], args[1], ndim))
+        elif name == "transpose":
+            _transpose(list(args[0]))
+        elif name == "rot90":  # Mirrors np.rot90
+            k = args[0] % 4 if len(args) > 0 else 1
+            axes = args[1] if len(args) > 1 else (0, 1)
+            axes_list = list(range(ndim))
+            axes_list[axes[0]], axes_list[axes[1]] = axes_list[axes[1]], axes_list[axes[0]]
+            if k == 1:
+                _flip(axes[1])
+                _transpose(axes_list)
+            elif k == 2:
+                _flip(axes[0])
+                _flip(axes[1])
+            elif k == 3:
+                _transpose(axes_list)
+                _flip(axes[1])
+        elif name == "fliplr":
+            _flip(1)
+        elif name == "flipud":
+            _flip(0)
+        elif name == "flip":
+            _flip(args[0])
+        else:
+            raise ValueError(f"Unknown orientation operation {name}")
+
+    return tuple(perm), tuple(flips)
+
+
+def apply_orientation(vol: np.ndarray, perm: tuple, flips: tuple) -> np.ndarray:
+    """
+    Applies a compiled orientation to `vol` as a view, no data is copied.
+    """
+    vol = np.transpose(vol, perm)
+    return vol[tuple(slice(None, None, -1) if f else slice(None) for f in flips)]
+
+
+def orient_into(
+        vol: np.ndarray, perm: tuple, flips: tuple, pad: Optional[tuple] = None, dtype=np.float64
+) -> np.ndarray:
+    """
+    Orients, pads and casts `vol` in a single pass, writing straight into a preallocated padded output of `dtype`.
+    Equivalent to `np.pad(apply_orientation(vol, perm, flips), pad).astype(dtype)` without the intermediate copies.
+    """
+    oriented = apply_orientation(vol, perm, flips)
+    pad = np.broadcast_to(np.asarray(pad if pad is not None else 0, dtype=int), (oriented.ndim, 2))
+    out_shape = tuple(n + before + after for n, (before, after) in zip(oriented.shape, pad))
+
+    # Output is allocated in the memory layout of `vol` and returned as a transposed view, as `astype` does, so the
+    # copy walks both arrays in memory order. np.zeros gets pre-zeroed pages, cheaper than zeroing strided borders
+    inv_perm = np.argsort(perm)
+    order = "F" if vol.flags.f_contiguous and not vol.flags.c_contiguous else "C"
+    alloc = np.zeros if np.any(pad) else np.empty
+    buffer = alloc(tuple(out_shape[j] for j in inv_perm), dtype=dtype, order=order)
+    out = np.transpose(buffer, perm)
+    out[tuple(slice(before, before + n) for n, (before, _) in zip(oriented.shape, pad))] = oriented
+    return out
@@ -1,8 +1,14 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Tuple
 
 import numpy as np
 import pydicom as pyd
 
+from common_utils import instrumentation
+from common_utils.integer_volume import IntegerVolume
+
 
 def _get_dcm_vol_max(dicoms: list) -> float:
     m = 0
@@ -12,32 +18,116 @@ def _get_dcm_vol_max(dicoms: list) -> float:
     return m
 
 
-def save_vol_as_DICOMs(original_dicoms, vol: np.ndarray, path_save: Path):
+def _get_dcm_vol_range(dicoms: list, from_header: bool = False) -> Tuple[int, int]:
+    """
+    Dynamic range of the original DICOMs, computed decoding each slice's pixel data once. With `from_header` it is
+    taken from the SmallestImagePixelValue/LargestImagePixelValue tags instead when every header has them.
+    """
+    if from_header and all(
+            "SmallestImagePixelValue" in dcm and "LargestImagePixelValue" in dcm for dcm in dicoms
+    ):
+        dcm_min = min(int(dcm.SmallestImagePixelValue) for dcm in dicoms)
+        dcm_max = max(int(dcm.LargestImagePixelValue) for dcm in dicoms)
+        return dcm_min, dcm_max
+
+    dcm_min, dcm_max = None, None
+    for dcm in dicoms:
+        pixel_array = dcm.pixel_array
+        _min, _max = int(pixel_array.min()), int(pixel_array.max())
+        dcm_min = _min if dcm_min is None else min(dcm_min, _min)
+        dcm_max = _max if dcm_max is None else max(dcm_max, _max)
+
+    return dcm_min, dcm_max
+
+
+def _write_dicom_slice(dcm: pyd.Dataset, s: np.ndarray, path_save_dcm: Path):
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.SamplesPerPixel = 1
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    if getattr(dcm, "file_meta", None) is None:  # Datasets not read from a file have no file meta
+        dcm.file_meta = pyd.dataset.FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = pyd.uid.ExplicitVRLittleEndian  # Native pixel data, even if read compressed
+
+    # Change default window levels for visualization
+    dcm["PixelData"].is_undefined_length = False
+    dcm.PixelData = s.tobytes()
+    dcm.WindowCenter = s.max() // 2
+    dcm.WindowWidth = s.max()
+    with instrumentation.stage("save_dicom.write") as stage:
+        pyd.dcmwrite(str(path_save_dcm), dcm, enforce_file_format=True)
+        stage.add_bytes(s.nbytes)
+
+
+def save_vol_as_DICOMs(
+        original_dicoms,
+        vol: np.ndarray,
+        path_save: Path,
+        chunk_size: int = 16,
+        num_workers: int = 4,
+        range_from_header: bool = False,
+):
+    """
+    Saves `vol` as one DICOM per slice, reusing the headers of `original_dicoms`. Slices are rescaled to the original
+    dynamic range one chunk at a time and written by a bounded I/O thread pool, so peak memory stays at a few chunks.
+
+    Parameters
+    ----------
+    original_dicoms : list
+        `pydicom.Dataset` of every slice of the original series, modified in place.
+    vol : np.ndarray
+        Normalized volume of shape (x, y, slices), or an `integer_volume.IntegerVolume` of stored pixel values (e.g.
+        loaded with `keep_integer=True`), which is written without rescaling. Plain integer arrays, such as 0/1 masks,
+        are rescaled like normalized volumes.
+    path_save : Path
+        Folder to write `{i}.dcm` into.
+    chunk_size : int, default=16
+        Number of slices rescaled at a time.
+    num_workers : int, default=4
+        Number of writer threads. 0 writes on the calling thread.
+    range_from_header : bool, default=False
+        Whether to read the original dynamic range from the SmallestImagePixelValue/LargestImagePixelValue tags when
+        present instead of decoding pixel data. Faster, but only correct when the tags match the pixel data, which
+        anonymization or processing often breaks.
+    """
     # Restore dynamic range
     # We do NOT re-normalize each slice since the entre denoised volume is normalized
-    dcm_all_min = [dcm.pixel_array.min() for dcm in original_dicoms]
-    dcm_all_max = [dcm.pixel_array.max() for dcm in original_dicoms]
-    dcm_min = np.min(dcm_all_min)
-    dcm_max = np.max(dcm_all_max)
-    vol_norm = (vol * (dcm_max - dcm_min)) + dcm_min
-    vol_norm = vol_norm.astype("uint16")
-
-    for i in range(vol.shape[-1]):
-        dcm = original_dicoms[i]
-        s = vol_norm[..., i]  # Slice
-
-        dcm.PhotometricInterpretation = "MONOCHROME2"
-        dcm.SamplesPerPixel = 1
-        dcm.BitsAllocated = 16
-        dcm.BitsStored = 16
-        dcm.HighBit = 15
-        dcm.is_little_endian = True
-
-        # Change default window levels for visualization
-        dcm.fix_meta_info()
-        dcm["PixelData"].is_undefined_length = False
-        dcm.PixelData = s.tobytes()
-        dcm.WindowCenter = s.max() // 2
-        dcm.WindowWidth = s.max()
-        path_save_dcm = path_save / f"{i}.dcm"
-        pyd.dcmwrite(str(path_save_dcm), dcm)
+    is_stored = isinstance(vol, IntegerVolume)
+    if not is_stored:
+        with instrumentation.stage("save_dicom.range"):
+            dcm_min, dcm_max = _get_dcm_vol_range(original_dicoms, from_header=range_from_header)
+
+    write_dicom_slice = instrumentation.bind_context(_write_dicom_slice)
+    pool = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+    pending = deque()
+    max_pending = 2 * chunk_size  # Bounds the number of rescaled slices held in memory
+    try:
+        for start in range(0, vol.shape[-1], chunk_size):
+            stop = min(start + chunk_size, vol.shape[-1])
+            with instrumentation.stage("save_dicom.rescale") as stage:
+                if is_stored:  # Stored values already, int16 keeps its two's complement bytes
+                    vol_norm = np.asarray(vol[..., start:stop]).astype("uint16")
+                else:
+                    vol_norm = vol[..., start:stop]
+                    if np.issubdtype(vol_norm.dtype, np.integer):  # e.g. uint8 masks, too narrow for the range
+                        vol_norm = vol_norm.astype(np.int64)
+                    vol_norm = (vol_norm * (dcm_max - dcm_min)) + dcm_min
+                    vol_norm = vol_norm.astype("uint16")
+                stage.add_bytes(vol_norm.nbytes)
+
+            for i in range(start, stop):
+                s = vol_norm[..., i - start]  # Slice
+                path_save_dcm = path_save / f"{i}.dcm"
+                if pool is None:
+                    write_dicom_slice(original_dicoms[i], s, path_save_dcm)
+                else:
+                    pending.append(pool.submit(write_dicom_slice, original_dicoms[i], s, path_save_dcm))
+
+            while len(pending) > max_pending:
+                pending.popleft().result()  # Re-raises write errors
+        while pending:
+            pending.popleft().result()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
@@ -0,0 +1,181 @@
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from common_utils import npy_shards
+from common_utils.sort_DCM import natural_sort
+
+
+class _SliceFile(NamedTuple):
+    path: Path
+    offset: int  # Byte offset of the array data
+    shape: tuple  # Shape of the array stored in the file
+    dtype: np.dtype
+    fortran_order: bool
+    stacked: bool  # Last axis indexes slices, else the file holds a single slice
+
+
+def _read_npy_header(path_npy: Path) -> Tuple[int, tuple, np.dtype, bool]:
+    with open(path_npy, "rb") as f:
+        major, _ = np.lib.format.read_magic(f)
+        if major == 1:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        return f.tell(), shape, dtype, fortran_order
+
+
+class SliceDataset:
+    """
+    Random access to the 2D slices of many volumes stored as .npy, without loading whole volumes. Only .npy headers
+    are read up front to build a sorted index of every (volume, slice) to its file and byte offset; a slice is then
+    read on request with a single seek.
+
+    Each source can be:
+    1. Folder of per-slice .npy files, as written by `dcm2npy`. Files are ordered by natural file name and assumed to
+       share the header of the first file.
+    2. Stacked (x, y, slices) .npy, as written by `dcm2npy_dataset(layout="volume")`.
+    3. Folder of shards with an `index.json`, as written by `dcm2npy_dataset(layout="shards")`.
+
+    Parameters
+    ----------
+    paths : list
+        Sources, one per volume.
+    dtype : np.dtype, optional
+        dtype slices are cast to. Defaults to the stored dtype.
+    """
+
+    def __init__(self, paths: List[Path], dtype=None):
+        self.paths = [Path(p) for p in paths]
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self._files = []  # type: List[_SliceFile]
+        self._memmaps = {}  # C ordered stacked files, where a slice is strided on disk
+
+        file_ids = []
+        local_ids = []
+        volume_ids = []
+        for v, path in enumerate(self.paths):
+            for f, n_slices in self._index_source(path):
+                file_ids.append(np.full(n_slices, len(self._files), dtype=np.int64))
+                local_ids.append(np.arange(n_slices, dtype=np.int64))
+                volume_ids.append(np.full(n_slices, v, dtype=np.int64))
+                self._files.append(f)
+
+        # Global slice index -> file, slice within file and volume
+        self._file_ids = np.concatenate(file_ids) if file_ids else np.zeros(0, dtype=np.int64)
+        self._local_ids = np.concatenate(local_ids) if local_ids else np.zeros(0, dtype=np.int64)
+        self._volume_ids = np.concatenate(volume_ids) if volume_ids else np.zeros(0, dtype=np.int64)
+        # Global index of the first slice of every volume
+        self._volume_starts = np.searchsorted(self._volume_ids, np.arange(len(self.paths)))
+
+    @staticmethod
+    def _index_source(path: Path) -> List[Tuple[_SliceFile, int]]:
+        if path.is_dir() and npy_shards.is_sharded(path):
+            index = npy_shards.read_index(path)
+            dtype = np.dtype(index["dtype"])
+            return [
+                (_SliceFile(path=path / s["file"], offset=s["offset"],
+                            shape=tuple(index["shape"][:-1]) + (s["stop"] - s["start"],), dtype=dtype,
+                            fortran_order=index.get("order", "F") == "F", stacked=True),
+                 s["stop"] - s["start"])
+                for s in index["shards"]
+            ]
+        elif path.is_dir():
+            files = natural_sort(list(path.glob("*.npy")))
+            if len(files) == 0:
+                return []
+            offset, shape, dtype, fortran_order = _read_npy_header(files[0])
+            return [
+                (_SliceFile(path=f, offset=offset, shape=shape, dtype=dtype, fortran_order=fortran_order,
+                            stacked=False), 1)
+                for f in files
+            ]
+        offset, shape, dtype, fortran_order = _read_npy_header(path)
+        f = _SliceFile(path=path, offset=offset, shape=shape, dtype=dtype, fortran_order=fortran_order, stacked=True)
+        return [(f, shape[-1])]
+
+    def __len__(self) -> int:
+        return len(self._file_ids)
+
+    @property
+    def num_volumes(self) -> int:
+        return len(self.paths)
+
+    def locate(self, i: int) -> Tuple[int, int]:
+        """
+        (volume, slice) of global slice `i`.
+        """
+        i = self._check_index(i)
+        return int(self._volume_ids[i]), int(i - self._volume_starts[self._volume_ids[i]])
+
+    def _check_index(self, i: int) -> int:
+        n = len(self)
+        if not -n <= i < n:
+            raise IndexError(f"Slice index {i} out of range for dataset of {n} slices")
+        return i % n
+
+    def _read_slice(self, f: _SliceFile, local: int) -> np.ndarray:
+        if not f.stacked:
+            count = int(np.prod(f.shape))
+            s = np.fromfile(f.path, dtype=f.dtype, count=count, offset=f.offset)
+            return s.reshape(f.shape, order="F" if f.fortran_order else "C")
+
+        slice_shape = f.shape[:-1]
+        if f.fortran_order:  # Slice is one contiguous block
+            count = int(np.prod(slice_shape))
+            s = np.fromfile(f.path, dtype=f.dtype, count=count, offset=f.offset + local * count * f.dtype.itemsize)
+            return s.reshape(slice_shape, order="F")
+
+        if f.path not in self._memmaps:
+            self._memmaps[f.path] = np.load(str(f.path), mmap_mode="r")
+        return np.array(self._memmaps[f.path][..., local])
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        i = self._check_index(i)
+        s = self._read_slice(self._files[self._file_ids[i]], int(self._local_ids[i]))
+        return s if self.dtype is None else s.astype(self.dtype, copy=False)
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_volume_slices(self, volume: int) -> range:
+        """
+        Global slice indices of `volume`.
+        """
+        start = int(self._volume_starts[volume])
+        stop = int(self._volume_starts[volume + 1]) if volume + 1 < self.num_volumes else len(self)
+        return range(start, stop)
+
+    def batches(
+            self,
+            batch_size: int,
+            shuffle: bool = True,
+            seed: Optional[Union[int, np.random.Generator]] = None,
+            drop_last: bool = False,
+            return_indices: bool = False,
+    ) -> Iterator[Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]]:
+        """
+        Iterates over all slices in batches of shape (batch_size, x, y). All slices must share the same in-plane shape.
+
+        Parameters
+        ==========
+        batch_size : int
+            Slices per batch.
+        shuffle : bool, default=True
+            Whether to visit slices in a random order, reshuffled on every call.
+        seed : int or np.random.Generator, optional
+            Seed of the shuffle.
+        drop_last : bool, default=False
+            Whether to drop the last batch if it has fewer than `batch_size` slices.
+        return_indices : bool, default=False
+            Whether to also yield the global slice indices of every batch.
+        """
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            if drop_last and len(indices) < batch_size:
+                break
+            batch = np.stack([self[i] for i in indices])
+            yield (batch, indices) if return_indices else batch
@@ -1,3 +1,6 @@
+import re
+
+
 def __get_DCM_filename(filename):
     return int(filename.stem)
 
@@ -10,7 +13,7 @@ def __get_MRDC_num(filename):
 def advanced_sort(files):
     try:
         sorted_files = sorted(files, key=lambda f: int(f.stem.split(".")[8].split("-")[-2]))
-    except:
+    except (IndexError, ValueError):
         sorted_files = sorted(files, key=lambda f: int(f.stem.split(".")[-4]))
 
     return sorted_files
@@ -23,3 +26,12 @@ def sort_DCM_filenames(files: list) -> list:
         return sorted(files, key=__get_MRDC_num)
     else:
         return advanced_sort(files)
+
+
+def __natural_key(filename):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", filename.name)]
+
+
+def natural_sort(files: list) -> list:
+    # Sorts by file name with embedded numbers compared numerically, so slice_2.npy comes before slice_10.npy
+    return sorted(files, key=__natural_key)
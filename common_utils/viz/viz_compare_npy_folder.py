@@ -16,10 +16,10 @@ def main(path_read_npy1: Path,
     arr2 = []
     for i in range(len(files1)):
         npy1 = np.load(str(files1[i]))
-        npy1 = npy1.astype(np.float).squeeze()
+        npy1 = npy1.astype(np.float64).squeeze()
 
         npy2 = np.load(str(files2[i]))
-        npy2 = npy2.astype(np.float).squeeze()
+        npy2 = npy2.astype(np.float64).squeeze()
 
         if viz_3D:
             arr1.append(npy1)
@@ -7,14 +7,17 @@ from common_utils import data_loader
 def main(path_nii: Path, dataset: str):
     if path_nii.is_dir():
         files = data_loader.glob_nifti(path_nii)
-        for f in files:
-            nii = data_loader.load_data(
-                path_data=f,
+        # Next volumes are loaded while the current one is being viewed
+        for f, nii in data_loader.iter_volumes(
+                files,
                 data_format="nifti",
                 normalize=True,
                 nifti_dataset=dataset,
                 central_50pc_crop=False,
-            )
+        ):
+            if isinstance(nii, Exception):
+                print(f"Failed to load {f}: {nii}")
+                continue
             print(nii.shape)
             sass.scroll(nii)
     else:
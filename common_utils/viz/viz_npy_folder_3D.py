@@ -13,7 +13,7 @@ def main(path_read_npy: Path, viz_3D=False):
     arr = []
     for f in files:
         npy = np.load(str(f))
-        npy = npy.astype(np.float).squeeze()
+        npy = npy.astype(np.float64).squeeze()
         npy = cv2.resize(npy, (256, 256))  # Resize
         npy = preprocessor.normalize_per_slice(npy)  # Normalize
 
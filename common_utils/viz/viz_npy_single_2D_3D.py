@@ -8,7 +8,7 @@ import sass
 
 def main(path_read_npy: Path, viz_3D=False):
     npy = np.load(str(path_read_npy))
-    npy = npy.astype(np.float).squeeze()
+    npy = npy.astype(np.float64).squeeze()
 
     if viz_3D:
         sass.scroll(npy)
@@ -11,7 +11,7 @@ def main(path_read_txt: Path, viz_3D=False):
     arr = []
     for line in text:
         npy = np.load(str(path_read_txt.parent / line.strip()))
-        npy = npy.astype(np.float).squeeze()
+        npy = npy.astype(np.float64).squeeze()
 
         if viz_3D:
             arr.append(npy)
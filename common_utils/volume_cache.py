@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+# Bump to invalidate every existing cache entry when the stored layout changes
+_CACHE_VERSION = 1
+# Temporary files of `put` not modified for this long are left over from a killed writer. Writers still in progress keep
+# updating theirs; a pid check would not work for a cache shared between hosts
+_STALE_TMP_SECONDS = 60 * 60
+
+
+class VolumeCache:
+    """
+    Size-bounded, on-disk LRU cache of preprocessed volumes. Each entry is a single `.npy` file that is memory-mapped
+    on a hit. Recency is tracked through file mtimes, so the LRU order survives across processes and runs. Temporary
+    files left by writers killed mid-write are removed on start-up and on eviction.
+
+    Parameters
+    ----------
+    path_cache : Path
+        Directory holding the cached `.npy` files. Created if it does not exist.
+    max_bytes : int, default=10 GiB
+        Total size of the cache directory above which the least recently used entries are evicted.
+    mmap_mode : str, default="r"
+        `mmap_mode` passed to `np.load` on a hit. None loads the entry into memory instead.
+    """
+
+    def __init__(self, path_cache: Path, max_bytes: int = 10 * 1024 ** 3, mmap_mode: Optional[str] = "r"):
+        self.path_cache = Path(path_cache)
+        self.path_cache.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._remove_stale_tmp()
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    @staticmethod
+    def key(sources: list, **kwargs) -> str:
+        """
+        Fingerprints the source files (path, mtime, size) together with the arguments that affect the result.
+        """
+        fingerprint = []
+        for f in sorted(str(Path(s).absolute()) for s in sources):
+            stat = os.stat(f)
+            fingerprint.append((f, stat.st_mtime_ns, stat.st_size))
+        payload = json.dumps(
+            {"version": _CACHE_VERSION, "sources": fingerprint, "args": kwargs}, sort_keys=True, default=str
+        )
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.path_cache / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path_entry = self._path(key)
+        try:
+            vol = np.load(str(path_entry), mmap_mode=self.mmap_mode)
+            os.utime(path_entry)  # Mark as most recently used
+        except FileNotFoundError:  # Also covers an entry evicted by another process in the meantime
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return vol
+
+    def put(self, key: str, vol: np.ndarray):
+        path_entry = self._path(key)
+        path_tmp = self.path_cache / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(path_tmp, "wb") as f:
+            np.save(f, vol)
+        os.replace(path_tmp, path_entry)  # Atomic, readers never see a partial entry
+
+        self.evict()
+
+    def _remove_stale_tmp(self):
+        stale_before = time.time() - _STALE_TMP_SECONDS
+        for f in self.path_cache.glob("*.tmp"):
+            try:
+                if f.stat().st_mtime < stale_before:
+                    f.unlink()
+            except FileNotFoundError:  # Renamed by its writer or removed by another process
+                continue
+
+    def evict(self):
+        """
+        Removes stale temporary files, then least recently used entries until the cache fits in `max_bytes`.
+        """
+        self._remove_stale_tmp()
+        entries = []
+        for f in self.path_cache.glob("*.npy"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, f))
+
+        total = sum(e[1] for e in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        for f in self.path_cache.glob("*.npy"):
+            f.unlink(missing_ok=True)
@@ -0,0 +1,250 @@
+import itertools
+import json
+import math
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from common_utils import instrumentation
+from common_utils.integer_volume import IntegerVolume
+from common_utils.lazy_volume import _expand_key
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # lz4 is optional, only needed for the "lz4" codec
+    lz4_frame = None
+
+METADATA_FILENAME = "store.json"
+CODECS = ("zlib", "lz4", "none")
+
+
+def _default_chunks(shape: tuple) -> tuple:
+    # One chunk per slice: whole planes, so reading a slice decodes exactly one chunk
+    return tuple(shape[:2]) + (1,) * (len(shape) - 2)
+
+
+def _chunk_filename(chunk_index: tuple) -> str:
+    return ".".join(str(i) for i in chunk_index)
+
+
+def _encode(chunk: np.ndarray, codec: str, level: int, shuffle: bool) -> bytes:
+    if shuffle and chunk.dtype.itemsize > 1:
+        # Byte shuffle: all first bytes, then all second bytes... High bytes of neighbouring voxels are mostly equal,
+        # which compresses far better than interleaved little-endian values
+        interleaved = np.ascontiguousarray(chunk).view(np.uint8).reshape(-1, chunk.dtype.itemsize)
+        data = np.empty(interleaved.shape[::-1], dtype=np.uint8)
+        for b in range(chunk.dtype.itemsize):  # One strided copy per byte, several times faster than a transpose copy
+            data[b] = interleaved[:, b]
+        data = data.tobytes()
+    else:
+        data = np.ascontiguousarray(chunk).tobytes()
+
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "lz4":
+        return lz4_frame.compress(data, compression_level=level)
+    return data
+
+
+def _decode(raw: bytes, codec: str, shuffle: bool, dtype: np.dtype, shape: tuple) -> np.ndarray:
+    if codec == "zlib":
+        raw = zlib.decompress(raw)
+    elif codec == "lz4":
+        raw = lz4_frame.decompress(raw)
+
+    data = np.frombuffer(raw, dtype=np.uint8)
+    if shuffle and dtype.itemsize > 1:
+        planes = data.reshape(dtype.itemsize, -1)
+        data = np.empty(planes.shape[::-1], dtype=np.uint8)
+        for b in range(dtype.itemsize):
+            data[:, b] = planes[b]
+    else:
+        data = data.copy()  # frombuffer is read-only
+    return data.view(dtype).reshape(shape)
+
+
+def _check_codec(codec: str):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}. Expected one of {CODECS}")
+    if codec == "lz4" and lz4_frame is None:
+        raise ImportError("The lz4 codec requires the lz4 package")
+
+
+def save_store(
+        vol: np.ndarray,
+        path_store: Path,
+        chunks: Optional[tuple] = None,
+        codec: str = "zlib",
+        level: int = 1,
+        shuffle: bool = True,
+) -> dict:
+    """
+    Saves `vol` as a chunked, compressed volume store: a folder of one compressed file per chunk, named after its
+    position in the chunk grid (e.g. "0.0.12"), and a `store.json` of shape, dtype, chunks and codec. Only the chunks
+    overlapping a requested region are read and decoded, see `VolumeStore`.
+
+    Parameters
+    ----------
+    vol : np.ndarray
+        Volume of shape (x, y, slices, ...), may be a np.memmap. `integer_volume.IntegerVolume` keeps its rescale.
+    path_store : Path
+        Folder to write the store into.
+    chunks : tuple, optional
+        Chunk shape, clipped to the volume. Defaults to one whole slice per chunk, (x, y, 1); (x, y, n) chunks slabs
+        of n slices, which compress better but decode n slices to read one.
+    codec : str, default="zlib"
+        One of zlib, lz4 (requires lz4, faster to decode) or none.
+    level : int, default=1
+        Compression level of the codec.
+    shuffle : bool, default=True
+        Whether to byte-shuffle multi-byte values before compressing.
+
+    Returns
+    -------
+    metadata : dict
+        Contents of `store.json`.
+    """
+    _check_codec(codec)
+    chunks = _default_chunks(vol.shape) if chunks is None else tuple(chunks)
+    if len(chunks) != vol.ndim or any(c < 1 for c in chunks):
+        raise ValueError(f"chunks must be {vol.ndim} positive sizes, got {chunks}")
+    chunks = tuple(min(c, n) if n > 0 else c for c, n in zip(chunks, vol.shape))
+
+    path_store.mkdir(parents=True, exist_ok=True)
+    grid = [range(math.ceil(n / c)) for n, c in zip(vol.shape, chunks)]
+    nbytes_stored = 0
+    with instrumentation.stage("volume_store.save", codec=codec) as s:
+        for chunk_index in itertools.product(*grid):
+            key = tuple(slice(i * c, (i + 1) * c) for i, c in zip(chunk_index, chunks))
+            raw = _encode(np.asarray(vol[key]), codec, level, shuffle)
+            (path_store / _chunk_filename(chunk_index)).write_bytes(raw)
+            nbytes_stored += len(raw)
+        s.add_bytes(nbytes_stored)
+
+    metadata = {
+        "shape": list(vol.shape),
+        "dtype": np.dtype(vol.dtype).str,
+        "chunks": list(chunks),
+        "codec": codec,
+        "level": level,
+        "shuffle": shuffle,
+        "nbytes_stored": nbytes_stored,
+    }
+    if isinstance(vol, IntegerVolume):
+        metadata["rescale"] = [vol.slope, vol.intercept]
+    # Written last, so a store interrupted while writing chunks is not mistaken for a complete one
+    with open(path_store / METADATA_FILENAME, "w") as f:
+        json.dump(metadata, f, indent=1)
+
+    return metadata
+
+
+def is_store(path_store: Path) -> bool:
+    return (path_store / METADATA_FILENAME).is_file()
+
+
+class VolumeStore:
+    """
+    Read access to a store written by `save_store`. Indexing (integers, slices, Ellipsis) decodes only the chunks
+    overlapping the requested region, e.g. `store[..., 40:60]` reads 20 slices.
+
+    Parameters
+    ----------
+    path_store : Path
+        Store folder.
+    num_workers : int, default=0
+        Number of threads decoding chunks concurrently. zlib and lz4 release the GIL while decompressing.
+    """
+
+    def __init__(self, path_store: Path, num_workers: int = 0):
+        self.path_store = Path(path_store)
+        with open(self.path_store / METADATA_FILENAME) as f:
+            self.metadata = json.load(f)
+        self.shape = tuple(self.metadata["shape"])
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.chunks = tuple(self.metadata["chunks"])
+        self.codec = self.metadata["codec"]
+        self.shuffle = self.metadata["shuffle"]
+        self.num_workers = num_workers
+        _check_codec(self.codec)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        vol = self[...]
+        return vol if dtype is None else vol.astype(dtype, copy=False)
+
+    def _chunk_shape(self, chunk_index: tuple) -> tuple:
+        return tuple(min(c, n - i * c) for i, c, n in zip(chunk_index, self.chunks, self.shape))
+
+    def _read_chunk(self, chunk_index: tuple) -> np.ndarray:
+        raw = (self.path_store / _chunk_filename(chunk_index)).read_bytes()
+        return _decode(raw, self.codec, self.shuffle, self.dtype, self._chunk_shape(chunk_index))
+
+    def read_block(self, start: tuple, stop: tuple) -> np.ndarray:
+        """
+        Reads the box [start, stop) along every axis.
+        """
+        out = np.empty(tuple(hi - lo for lo, hi in zip(start, stop)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        grid = [range(lo // c, (hi - 1) // c + 1) for lo, hi, c in zip(start, stop, self.chunks)]
+
+        def _copy_chunk(chunk_index: tuple):
+            chunk = self._read_chunk(chunk_index)
+            src, dst = [], []
+            for i, c, lo, hi in zip(chunk_index, self.chunks, start, stop):
+                origin = i * c
+                first, last = max(lo, origin), min(hi, origin + c)
+                src.append(slice(first - origin, last - origin))
+                dst.append(slice(first - lo, last - lo))
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        with instrumentation.stage("volume_store.read") as s:
+            chunk_indices = list(itertools.product(*grid))
+            if self.num_workers > 0 and len(chunk_indices) > 1:
+                with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+                    list(pool.map(instrumentation.bind_context(_copy_chunk), chunk_indices))
+            else:
+                for chunk_index in chunk_indices:
+                    _copy_chunk(chunk_index)
+            s.add_bytes(out.nbytes)
+        return out
+
+    def __getitem__(self, key) -> np.ndarray:
+        start, stop, local_key = [], [], []
+        for k, n in zip(_expand_key(key, self.ndim), self.shape):
+            if isinstance(k, slice):
+                r = range(n)[k]
+                if len(r) == 0:
+                    start.append(0)
+                    stop.append(0)
+                    local_key.append(slice(None))
+                    continue
+                lo, hi = min(r[0], r[-1]), max(r[0], r[-1]) + 1
+                start.append(lo)
+                stop.append(hi)
+                local_stop = r[-1] - lo + (1 if r.step > 0 else -1)
+                local_key.append(slice(r[0] - lo, local_stop if local_stop >= 0 else None, r.step))
+            elif isinstance(k, (int, np.integer)):
+                i = range(n)[k]  # Raises IndexError when out of bounds
+                start.append(i)
+                stop.append(i + 1)
+                local_key.append(0)
+            else:
+                raise IndexError(f"Only integers, slices and Ellipsis are supported, got {type(k).__name__}")
+
+        vol = self.read_block(tuple(start), tuple(stop))[tuple(local_key)]
+        if "rescale" in self.metadata:
+            slope, intercept = self.metadata["rescale"]
+            return IntegerVolume(vol, slope=slope, intercept=intercept)
+        return vol
+